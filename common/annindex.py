@@ -0,0 +1,346 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from pathlib import Path
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+INDEX_VERSION = 1
+
+
+class AnnIndex:
+    """NGT, hnsw or faiss-flat index of packed hashes, saved in a directory and updated in place.
+
+    The directory has the index of the engine, the filenames, hashes and index ids of the
+    indexed images and the neighbor pairs found by the last search. sync() inserts new and
+    changed hashes and deletes lost ones, so a run only pays for the images changed since
+    the last run. meta.json is written last, so a partly written index is rebuilt. Without
+    a path, the index is built in a temporary directory and removed by close().
+    """
+
+    def __init__(self, engine, hash_bits, args, num_proc, path=None, executor=None, cuda_device=None):
+        self.engine = engine
+        self.hash_bits = hash_bits
+        self.args = args
+        self.num_proc = num_proc
+        self.executor = executor
+        self.cuda_device = cuda_device
+        self.path = Path(path) if path else None
+        self.temp_dir = None
+        self.index = None
+        self.search_index = None
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.row_of_id = np.zeros(0, dtype=np.int64)
+        self.next_id = 0
+        self.num_deleted = 0
+        self.pairs = None
+
+
+    def build_params(self):
+        # an index saved with other parameters is rebuilt
+        args = self.args
+        if self.engine == 'ngt':
+            return {'edges': args.ngt_edges, 'edges_for_search': args.ngt_edges_for_search}
+        elif self.engine == 'hnsw':
+            return {'ef_construction': args.hnsw_ef_construction, 'm': args.hnsw_m}
+        return {}
+
+
+    def search_params(self):
+        # pairs saved with other parameters are searched again
+        args = self.args
+        if self.engine == 'ngt':
+            return {'hamming_distance': args.hamming_distance, 'k': args.ngt_k, 'epsilon': args.ngt_epsilon}
+        elif self.engine == 'hnsw':
+            return {'hamming_distance': args.hamming_distance, 'k': args.hnsw_k, 'ef': args.hnsw_ef}
+        return {'hamming_distance': args.hamming_distance, 'k': args.faiss_flat_k}
+
+
+    def index_dir(self):
+        if self.path is not None:
+            return self.path
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.mkdtemp(prefix="imgdupes_{}_".format(self.engine.replace('-', '_')))
+        return Path(self.temp_dir)
+
+
+    def read_meta(self):
+        meta_path = self.path / 'meta.json'
+        if not meta_path.exists():
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta.get('version') != INDEX_VERSION or meta.get('engine') != self.engine
+                or meta.get('hash_bits') != self.hash_bits or meta.get('build_params') != self.build_params()):
+            return None
+        return meta
+
+
+    def sync(self, filenames, packed_hshs):
+        # Make the index hold exactly packed_hshs, one per filename. Return the rows of
+        # packed_hshs inserted into the index, which have not been searched yet.
+        packed_hshs = np.ascontiguousarray(packed_hshs, dtype=np.uint8)
+        saved = self.load() if self.path is not None else None
+        if saved is None:
+            self.build(packed_hshs)
+            return np.arange(len(filenames))
+        saved_filenames, saved_hashes, saved_ids = saved
+
+        saved_row = {f: row for row, f in enumerate(saved_filenames)}
+        ids = np.full(len(filenames), -1, dtype=np.int64)
+        for row, filename in enumerate(filenames):
+            srow = saved_row.get(filename)
+            if srow is not None and (saved_hashes[srow] == packed_hshs[row]).all():
+                ids[row] = saved_ids[srow]
+        lost = np.setdiff1d(saved_ids, ids[ids >= 0])
+        new_rows = np.nonzero(ids < 0)[0]
+        if self.num_deleted + len(lost) > len(filenames):
+            # too many holes, build a compact index
+            logger.debug("Rebuild {} index: {} deleted images".format(self.engine, self.num_deleted + len(lost)))
+            self.build(packed_hshs)
+            return np.arange(len(filenames))
+        logger.debug("Update {} index: {} new, {} lost images".format(self.engine, len(new_rows), len(lost)))
+
+        self.remove(lost)
+        self.num_deleted += len(lost)
+        if self.pairs is not None:
+            alive = np.isin(self.pairs[0], ids) & np.isin(self.pairs[1], ids)
+            self.pairs = tuple(column[alive] for column in self.pairs)
+        ids[new_rows] = self.insert(packed_hshs[new_rows])
+        self.set_ids(ids)
+        return new_rows
+
+
+    def load(self):
+        # load the saved index, return (filenames, hashes, ids) or None
+        meta = self.read_meta()
+        if meta is None:
+            return None
+        try:
+            with open(self.path / 'filenames', 'rb') as f:
+                data = f.read()
+            filenames = [os.fsdecode(name) for name in data.split(b'\0')] if len(data) > 0 else []
+            hashes = np.load(self.path / 'hashes.npy')
+            ids = np.load(self.path / 'ids.npy')
+            if self.engine == 'ngt':
+                import ngtpy
+                self.index = ngtpy.Index(str(self.path / 'ngt').encode())
+            elif self.engine == 'hnsw':
+                import hnswlib
+                self.index = hnswlib.Index(space='l2', dim=self.hash_bits) # Squared L2
+                self.index.load_index(str(self.path / 'index.hnsw'), max_elements=meta['max_elements'])
+                self.set_hnsw_params()
+            else:
+                import faiss
+                self.index = faiss.read_index(str(self.path / 'index.faiss'))
+            if meta.get('search_params') == self.search_params():
+                pairs = np.load(self.path / 'pairs.npy')
+                self.pairs = (pairs[0], pairs[1], pairs[2])
+        except (OSError, RuntimeError, ValueError) as e:
+            logger.warning("Unable to load {} index, rebuilding it: {}".format(self.engine, e))
+            self.index = None
+            self.pairs = None
+            return None
+        self.next_id = meta['next_id']
+        self.num_deleted = meta['num_deleted']
+        logger.debug("Load {} index: {}".format(self.engine, self.path))
+        return filenames, hashes, ids
+
+
+    def build(self, packed_hshs):
+        args = self.args
+        self.close_index()
+        unpacked = np.unpackbits(packed_hshs, axis=-1, count=self.hash_bits)
+        num_elements = len(packed_hshs)
+        index_dir = self.index_dir()
+        if self.path is not None:
+            self.clear()
+        index_dir.mkdir(parents=True, exist_ok=True)
+        if self.engine == 'ngt':
+            import ngtpy
+            ngtpy.create(path=str(index_dir / 'ngt').encode(),
+                dimension=self.hash_bits,
+                edge_size_for_creation=args.ngt_edges,
+                edge_size_for_search=args.ngt_edges_for_search,
+                object_type="Byte",
+                distance_type="Hamming")
+            self.index = ngtpy.Index(str(index_dir / 'ngt').encode())
+            self.index.batch_insert(unpacked, self.num_proc)
+        elif self.engine == 'hnsw':
+            import hnswlib
+            self.index = hnswlib.Index(space='l2', dim=self.hash_bits) # Squared L2
+            self.index.init_index(max_elements=max(num_elements, 1), ef_construction=args.hnsw_ef_construction, M=args.hnsw_m)
+            self.set_hnsw_params()
+            self.index.add_items(unpacked, np.arange(num_elements), self.num_proc)
+        else:
+            import faiss
+            faiss.omp_set_num_threads(self.num_proc)
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.hash_bits))  # Exact search
+            self.index.add_with_ids(unpacked.astype('float32'), np.arange(num_elements, dtype=np.int64))
+        # ids of a new index are the rows
+        self.next_id = num_elements
+        self.num_deleted = 0
+        self.pairs = None
+        self.set_ids(np.arange(num_elements, dtype=np.int64))
+
+
+    def set_hnsw_params(self):
+        self.index.set_ef(max(self.args.hnsw_ef, self.args.hnsw_k - 1)) # ef should always be > k
+        self.index.set_num_threads(self.num_proc)
+
+
+    def set_ids(self, ids):
+        self.ids = ids
+        self.row_of_id = np.full(max(int(ids.max()) + 1 if len(ids) > 0 else 0, self.next_id), -1, dtype=np.int64)
+        self.row_of_id[ids] = np.arange(len(ids))
+        self.search_index = None
+
+
+    def remove(self, ids):
+        if len(ids) == 0:
+            return
+        if self.engine == 'ngt':
+            for index_id in ids:
+                self.index.remove(int(index_id))
+        elif self.engine == 'hnsw':
+            for index_id in ids:
+                self.index.mark_deleted(int(index_id))
+        else:
+            self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+
+    def insert(self, packed_hshs):
+        # insert hashes into the index, return their ids
+        if len(packed_hshs) == 0:
+            return np.zeros(0, dtype=np.int64)
+        unpacked = np.unpackbits(packed_hshs, axis=-1, count=self.hash_bits)
+        if self.engine == 'ngt':
+            # NGT assigns the ids, and reuses the ids of removed objects
+            ids = np.array([self.index.insert(hsh) for hsh in unpacked], dtype=np.int64)
+            self.index.build_index(self.num_proc)
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+            return ids
+        ids = np.arange(self.next_id, self.next_id + len(unpacked), dtype=np.int64)
+        self.next_id += len(unpacked)
+        if self.engine == 'hnsw':
+            if self.index.get_current_count() + len(unpacked) > self.index.get_max_elements():
+                self.index.resize_index(self.index.get_current_count() + len(unpacked))
+            self.index.add_items(unpacked, ids, self.num_proc)
+        else:
+            self.index.add_with_ids(unpacked.astype('float32'), ids)
+        return ids
+
+
+    def search(self, packed_queries):
+        # return (rows, distances) of the k nearest neighbors of each query, row -1 when missing
+        args = self.args
+        unpacked = np.unpackbits(np.asarray(packed_queries, dtype=np.uint8).reshape(len(packed_queries), -1), axis=-1, count=self.hash_bits)
+        if self.engine == 'ngt':
+            k = args.ngt_k
+            ids = np.full((len(unpacked), k), -1, dtype=np.int64)
+            distances = np.zeros((len(unpacked), k), dtype=np.float32)
+            search = lambda hsh: self.index.search(hsh, size=k, epsilon=args.ngt_epsilon)
+            results = self.executor.map(search, unpacked) if self.executor is not None else map(search, unpacked)
+            for row, result in enumerate(results):
+                for col, (index_id, distance) in enumerate(result):
+                    ids[row, col] = index_id
+                    distances[row, col] = distance
+        elif self.engine == 'hnsw':
+            k = min(args.hnsw_k, len(self.ids))
+            if k == 0:
+                return np.zeros((len(unpacked), 0), dtype=np.int64), np.zeros((len(unpacked), 0), dtype=np.float32)
+            ids, distances = self.index.knn_query(unpacked, k=k, num_threads=self.num_proc)
+        else:
+            distances, ids = self.get_search_index().search(unpacked.astype('float32'), args.faiss_flat_k)
+        ids = np.asarray(ids, dtype=np.int64)
+        known = (ids >= 0) & (ids < len(self.row_of_id))
+        rows = np.full(ids.shape, -1, dtype=np.int64)
+        rows[known] = self.row_of_id[ids[known]]
+        return rows, distances
+
+
+    def get_search_index(self):
+        # faiss searches a copy of the index on the CUDA device when given
+        if self.cuda_device is None:
+            return self.index
+        if self.search_index is None:
+            import faiss
+            res = faiss.StandardGpuResources()
+            self.search_index = faiss.index_cpu_to_gpu(res, self.cuda_device, self.index)  # Convert to CUDA
+        return self.search_index
+
+
+    def known_pairs(self):
+        # (src, dst, distance) rows of the pairs found by the last run, None when the pairs
+        # were searched with other parameters
+        if self.pairs is None:
+            return None
+        src, dst, distances = self.pairs
+        return self.row_of_id[src], self.row_of_id[dst], distances
+
+
+    def save(self, filenames, packed_hshs, pairs=None):
+        # save the index with (src, dst, distance) rows of the neighbor pairs of all images
+        if self.path is None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            meta_path.unlink()
+        with open(self.path / 'filenames', 'wb') as f:
+            f.write(b'\0'.join(os.fsencode(name) for name in filenames))
+        np.save(self.path / 'hashes.npy', np.asarray(packed_hshs, dtype=np.uint8))
+        np.save(self.path / 'ids.npy', self.ids)
+        meta = {
+            'version': INDEX_VERSION,
+            'engine': self.engine,
+            'hash_bits': self.hash_bits,
+            'build_params': self.build_params(),
+            'next_id': self.next_id,
+            'num_deleted': self.num_deleted,
+        }
+        if pairs is not None:
+            src, dst, distances = pairs
+            np.save(self.path / 'pairs.npy', np.stack([self.ids[src], self.ids[dst], np.asarray(distances, dtype=np.int64)]))
+            meta['search_params'] = self.search_params()
+        if self.engine == 'ngt':
+            self.index.save()
+        elif self.engine == 'hnsw':
+            self.index.save_index(str(self.path / 'index.hnsw'))
+            meta['max_elements'] = self.index.get_max_elements()
+        else:
+            import faiss
+            faiss.write_index(self.index, str(self.path / 'index.faiss'))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        logger.debug("Save {} index: {}".format(self.engine, self.path))
+
+
+    def clear(self):
+        # remove a saved index before building a new one
+        if self.path.exists():
+            shutil.rmtree(self.path)
+
+
+    def close_index(self):
+        if self.engine == 'ngt' and self.index is not None:
+            self.index.close()
+        self.index = None
+        self.search_index = None
+
+
+    def close(self):
+        self.close_index()
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
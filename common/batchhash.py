@@ -0,0 +1,52 @@
+from PIL import Image
+
+import numpy as np
+import scipy.fftpack
+
+
+# hash methods calculated by batch_hash, whash is calculated image by image
+BATCH_METHODS = ('ahash', 'dhash', 'phash', 'phash_org')
+
+# phash input is this many times larger than the hash
+HIGHFREQ_FACTOR = 4
+
+
+def input_size(hash_method, hash_size):
+    # (width, height) of the grayscale image hashed by hash_method, same as imagehash
+    if hash_method == 'ahash':
+        return hash_size, hash_size
+    elif hash_method == 'dhash':
+        return hash_size + 1, hash_size
+    elif hash_method in ('phash', 'phash_org'):
+        return hash_size * HIGHFREQ_FACTOR, hash_size * HIGHFREQ_FACTOR
+    raise ValueError("No batch kernel for {}".format(hash_method))
+
+
+def resize_gray(image, hash_method, hash_size):
+    # grayscale pixels of image resized to the input of hash_method
+    return np.asarray(image.convert("L").resize(input_size(hash_method, hash_size), Image.LANCZOS))
+
+
+def batch_hash(hash_method, pixels, hash_size):
+    # Packed hashes (K, hash_bytes) of K stacked grayscale inputs (K, height, width) made
+    # by resize_gray. Bit-identical to imagehash (and HashCache.phash_org) image by image.
+    if hash_size < 2:
+        raise ValueError("Hash size must be greater than or equal to 2")
+    pixels = np.asarray(pixels)
+    num_images = len(pixels)
+    if hash_method == 'ahash':
+        # sums of uint8 pixels are exact, so the means equal numpy.mean of each image
+        avg = pixels.reshape(num_images, -1).mean(axis=1)
+        diff = pixels > avg[:, None, None]
+    elif hash_method == 'dhash':
+        diff = pixels[:, :, 1:] > pixels[:, :, :-1]
+    elif hash_method in ('phash', 'phash_org'):
+        dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+        # phash_org excludes the DC coefficient
+        offset = 1 if hash_method == 'phash_org' else 0
+        dctlowfreq = dct[:, offset:hash_size + offset, offset:hash_size + offset]
+        med = np.median(dctlowfreq.reshape(num_images, -1), axis=1)
+        diff = dctlowfreq > med[:, None, None]
+    else:
+        raise ValueError("No batch kernel for {}".format(hash_method))
+    return np.packbits(diff.reshape(num_images, -1), axis=1)
@@ -0,0 +1,327 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from copy import copy
+from PIL import Image, ImageDraw, ImageFilter
+from pathlib import Path
+
+import importlib.util
+import json
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from common.batchhash import BATCH_METHODS, batch_hash, resize_gray
+from common.hamming import PopcountIndex, chunk_ranges
+from common.hashcache import HASH_CHUNKSIZE, HashCache
+from common.imagededuper import ImageDeduper
+from common.queryindex import QueryIndex
+from common.workers import Workers
+
+
+MANIFEST_NAME = 'bench_manifest.json'
+
+VARIANTS = ['resize', 'reencode', 'crop', 'watermark']
+
+# python module required by each search engine
+ENGINE_MODULES = {'ngt': 'ngtpy', 'hnsw': 'hnswlib', 'faiss-flat': 'faiss', 'popcount': None, 'mih': None, 'outofcore': None}
+
+ANN_ENGINES = ('ngt', 'hnsw', 'faiss-flat')
+
+
+def random_image(rng, width, height):
+    # smooth background with random shapes, different enough between seeds
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    start, end_x, end_y = rng.integers(0, 256, (3, 1, 1, 3))
+    background = start + (end_x - start) * x + (end_y - start) * y
+    img = Image.fromarray(np.clip(background, 0, 255).astype(np.uint8), 'RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(int(rng.integers(4, 12))):
+        x0, x1 = sorted(rng.integers(0, width, 2))
+        y0, y1 = sorted(rng.integers(0, height, 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+    return img.filter(ImageFilter.GaussianBlur(2))
+
+
+def make_variant(img, variant, rng):
+    width, height = img.size
+    if variant == 'resize':
+        scale = rng.uniform(0.4, 0.8)
+        return img.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS), 90
+    elif variant == 'reencode':
+        return img, int(rng.integers(30, 70))
+    elif variant == 'crop':
+        dx, dy = int(width * rng.uniform(0.02, 0.08)), int(height * rng.uniform(0.02, 0.08))
+        return img.crop((dx, dy, width - dx, height - dy)), 90
+    elif variant == 'watermark':
+        img = img.copy()
+        draw = ImageDraw.Draw(img)
+        x0, y0 = int(width * 0.6), int(height * 0.85)
+        draw.rectangle((x0, y0, width - 4, height - 4), fill=(255, 255, 255))
+        draw.text((x0 + 4, y0 + 2), "imgdupes", fill=(0, 0, 0))
+        return img, 90
+    raise ValueError("Unknown variant: {}".format(variant))
+
+
+def generate_corpus(corpus_dir, num_originals, variants, seed=0):
+    # write num_originals random images and their variants to corpus_dir, and a manifest
+    # mapping each filename to its original
+    corpus_dir = Path(corpus_dir)
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    groups = {}
+    for i in range(num_originals):
+        width, height = (int(v) for v in rng.integers(256, 640, 2))
+        img = random_image(rng, width, height)
+        name = "orig_{:06d}.jpg".format(i)
+        img.save(corpus_dir / name, quality=95)
+        groups[name] = i
+        for variant in variants:
+            variant_img, quality = make_variant(img, variant, rng)
+            variant_name = "orig_{:06d}_{}.jpg".format(i, variant)
+            variant_img.save(corpus_dir / variant_name, quality=quality)
+            groups[variant_name] = i
+    manifest = {'originals': num_originals, 'variants': variants, 'seed': seed, 'groups': groups}
+    with open(corpus_dir / MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest(corpus_dir):
+    path = Path(corpus_dir, MANIFEST_NAME)
+    if not path.exists():
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def engine_available(engine):
+    module = ENGINE_MODULES[engine]
+    return module is None or importlib.util.find_spec(module) is not None
+
+
+def bench_args(args, **kwargs):
+    # copy of args for one benchmark with the search engine flags kept consistent
+    args = copy(args)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    args.ngt = args.engine == 'ngt'
+    args.hnsw = args.engine == 'hnsw'
+    args.faiss_flat = args.engine == 'faiss-flat'
+    return args
+
+
+def bench_hashing(args, image_filenames, hash_method, hash_bits, cache_dir):
+    # hash all images into an empty hash cache, dump it and load it again
+    args = bench_args(args, hash_method=hash_method, hash_bits=hash_bits, cache=True, cache_dir=cache_dir)
+    with Workers(args.num_proc) as workers:
+        deduper = ImageDeduper(args, list(image_filenames), workers)
+        start = time.perf_counter()
+        deduper.load_hashcache()
+        hash_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        deduper.dump_hashcache()
+        dump_seconds = time.perf_counter() - start
+    with Workers(args.num_proc) as workers:
+        cached = ImageDeduper(args, list(image_filenames), workers)
+        start = time.perf_counter()
+        cached.load_hashcache()
+        load_seconds = time.perf_counter() - start
+    num_images = len(deduper.hashcache.filename_list)
+    return deduper, {
+        'hash_method': hash_method,
+        'hash_bits': deduper.hash_bits,
+        'fast_decode': args.fast_decode,
+        'images': num_images,
+        'failed': int(deduper.hashcache.failed.sum()),
+        'hash_seconds': hash_seconds,
+        'images_per_second': num_images / hash_seconds if hash_seconds > 0 else None,
+        'cache_dump_seconds': dump_seconds,
+        'cache_load_seconds': load_seconds,
+    }
+
+
+def bench_kernels(image_filenames, hash_method, hash_size):
+    # compare the batch kernel of hash_method with its reference hash function image by
+    # image, on the same grayscale decodes, chunk by chunk as in the hashing processes
+    hashcache = HashCache(None, [], hash_method, hash_size, 1)
+    num_images = 0
+    mismatches = 0
+    reference_seconds = 0.0
+    batch_seconds = 0.0
+    for start, end in chunk_ranges(len(image_filenames), HASH_CHUNKSIZE):
+        grays = []
+        for filename in image_filenames[start:end]:
+            try:
+                with Image.open(filename) as img:
+                    grays.append(img.convert("L"))
+            except:
+                continue
+        if len(grays) == 0:
+            continue
+        begin = time.perf_counter()
+        reference = [hashcache.hash_image(gray) for gray in grays]
+        reference_seconds += time.perf_counter() - begin
+        begin = time.perf_counter()
+        packed = batch_hash(hash_method, np.stack([resize_gray(gray, hash_method, hash_size) for gray in grays]), hash_size)
+        batch_seconds += time.perf_counter() - begin
+        num_images += len(grays)
+        mismatches += sum(1 for ref, hsh in zip(reference, packed) if ref is None or not np.array_equal(ref, hsh))
+    if mismatches > 0:
+        logger.error("Error: batch {} differs from the reference for {} of {} images".format(hash_method, mismatches, num_images))
+    return {
+        'hash_method': hash_method,
+        'hash_bits': hash_size ** 2,
+        'images': num_images,
+        'mismatches': mismatches,
+        'reference_seconds': reference_seconds,
+        'batch_seconds': batch_seconds,
+    }
+
+
+def pair_set(src, dst):
+    return set(zip(np.minimum(src, dst).tolist(), np.maximum(src, dst).tolist()))
+
+
+def bench_search(args, hashcache, engine, exact_pairs, params):
+    # build the index of engine, search every hash and compare pairs with exact_pairs
+    args = bench_args(args, engine=engine, **params)
+    filenames = hashcache.filenames()
+    row_of = {filename: row for row, filename in enumerate(filenames)}
+    packed = hashcache.packed_hshs()
+    with Workers(args.num_proc) as workers:
+        start = time.perf_counter()
+        index = QueryIndex(hashcache, args, workers)
+        build_seconds = time.perf_counter() - start
+        found = set()
+        start = time.perf_counter()
+        for batch_start, batch_end in chunk_ranges(len(packed), args.query_batch_size):
+            results = index.search(packed[batch_start:batch_end])
+            for row, matches in enumerate(results, start=batch_start):
+                for filename, _distance in matches:
+                    other = row_of[filename]
+                    if other != row:
+                        found.add((min(row, other), max(row, other)))
+        search_seconds = time.perf_counter() - start
+        index.close()
+    return {
+        'engine': engine,
+        'params': params,
+        'build_seconds': build_seconds,
+        'search_seconds': search_seconds,
+        'queries': len(packed),
+        'qps': len(packed) / search_seconds if search_seconds > 0 else None,
+        'pairs': len(found),
+        'recall': len(found & exact_pairs) / len(exact_pairs) if exact_pairs else 1.0,
+    }
+
+
+def engine_params(args, engine):
+    # search parameters of each benchmark of engine, one per --bench-k value
+    if engine not in ANN_ENGINES:
+        return [{}]
+    ks = args.bench_k or [None]
+    params = []
+    for k in ks:
+        if engine == 'ngt':
+            params.append({'ngt_k': k or args.ngt_k, 'ngt_epsilon': args.ngt_epsilon})
+        elif engine == 'hnsw':
+            k = k or args.hnsw_k
+            params.append({'hnsw_k': k, 'hnsw_ef': max(args.hnsw_ef, k)})
+        else:
+            params.append({'faiss_flat_k': k or args.faiss_flat_k})
+    return params
+
+
+def ground_truth_metrics(filenames, pairs, groups):
+    # precision and recall of pairs against the originals of the synthetic corpus
+    original = [groups.get(Path(filename).name) for filename in filenames]
+    truth = set()
+    members = {}
+    for row, group in enumerate(original):
+        if group is not None:
+            members.setdefault(group, []).append(row)
+    for rows in members.values():
+        truth.update((a, b) for i, a in enumerate(rows) for b in rows[i + 1:])
+    correct = sum(1 for a, b in pairs if original[a] is not None and original[a] == original[b])
+    return {
+        'true_pairs': len(truth),
+        'found_pairs': len(pairs),
+        'precision': correct / len(pairs) if pairs else 1.0,
+        'recall': correct / len(truth) if truth else 1.0,
+    }
+
+
+def run_bench(args, image_filenames):
+    # return the benchmark report as a dict
+    manifest = load_manifest(args.target_dir)
+    image_filenames = sorted(image_filenames)
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'num_proc': Workers(args.num_proc).num_proc,
+        },
+        'corpus': {
+            'path': args.target_dir,
+            'images': len(image_filenames),
+            'originals': manifest['originals'] if manifest else None,
+            'variants': manifest['variants'] if manifest else None,
+        },
+        'hashing': [],
+        'kernels': [],
+        'search': [],
+    }
+    cache_dir = tempfile.mkdtemp(prefix='imgdupes_bench_')
+    try:
+        hash_configs = [(args.hash_method, args.hash_bits)] + [config for config in args.bench_hashes
+            if config != (args.hash_method, args.hash_bits)]
+        deduper = None
+        for hash_method, hash_bits in hash_configs:
+            logger.warning("Benchmarking {} (hash_bits={})".format(hash_method, hash_bits))
+            hashed, result = bench_hashing(args, image_filenames, hash_method, hash_bits, cache_dir)
+            report['hashing'].append(result)
+            deduper = deduper or hashed
+            if hash_method in BATCH_METHODS:
+                report['kernels'].append(bench_kernels(image_filenames, hash_method, hashed.hash_size))
+
+        # search benchmarks use the hashes of hash_method and --hash-bits
+        hashcache = deduper.hashcache
+        packed = hashcache.packed_hshs()
+        start = time.perf_counter()
+        src, dst, _distances = PopcountIndex(packed, hashcache.hash_bits, num_threads=report['environment']['num_proc']).all_pairs(args.hamming_distance)
+        exact_pairs = pair_set(src, dst)
+        report['exact'] = {
+            'hash_method': args.hash_method,
+            'hash_bits': hashcache.hash_bits,
+            'hamming_distance': args.hamming_distance,
+            'pairs': len(exact_pairs),
+            'search_seconds': time.perf_counter() - start,
+        }
+        if manifest:
+            report['exact'].update(ground_truth_metrics(hashcache.filenames(), exact_pairs, manifest['groups']))
+
+        for engine in args.bench_engines:
+            if not engine_available(engine):
+                logger.warning("Skip {}: {} is not installed".format(engine, ENGINE_MODULES[engine]))
+                report['search'].append({'engine': engine, 'skipped': "{} is not installed".format(ENGINE_MODULES[engine])})
+                continue
+            for params in engine_params(args, engine):
+                logger.warning("Benchmarking {} search {}".format(engine, params))
+                report['search'].append(bench_search(args, hashcache, engine, exact_pairs, params))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return report
@@ -0,0 +1,216 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+DELETE_ACTIONS = ['delete', 'quarantine', 'hardlink', 'reflink']
+
+# ioctl of Linux which shares the extents of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# files waiting for a delete thread, per thread
+MAX_PENDING_PER_THREAD = 4
+
+
+class DeleteJournal:
+    """Write-ahead journal of delete actions, one JSON object per line.
+
+    A 'begin' entry is written before each action and a 'done', 'missing' or 'error'
+    entry after it, so an interrupted run shows which actions were completed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # opened at the first entry, so a run without deletes leaves no journal
+        self.file = None
+
+
+    def write(self, status, action, path, target=None, error=None):
+        entry = {'time': time.time(), 'status': status, 'action': action, 'path': path}
+        if target is not None:
+            entry['target'] = target
+        if error is not None:
+            entry['error'] = error
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(line)
+            self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+
+def read_journal(path):
+    # return the last entry of each (action, path) in order of the actions
+    entries = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            key = (entry['action'], entry['path'])
+            entries.pop(key, None)
+            entries[key] = entry
+    return list(entries.values())
+
+
+def quarantine_path(quarantine_dir, path):
+    # the absolute path of the file is kept under quarantine_dir
+    return str(Path(os.path.abspath(quarantine_dir)) / os.path.abspath(path).lstrip(os.sep))
+
+
+def replace_with(path, make_copy):
+    # replace path atomically with a file made by make_copy(temporary path)
+    tmp_path = "{}.imgdupes-tmp{}".format(path, os.getpid())
+    try:
+        make_copy(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+class DeleteExecutor:
+    """Deletes duplicate files on a bounded thread pool and journals every action.
+
+    action is one of DELETE_ACTIONS:
+      delete: unlink the file
+      quarantine: move the file under quarantine_dir (same filesystem), undoable
+      hardlink: replace the file with a hard link to the preserved file of its set
+      reflink: replace the file with a copy-on-write clone of the preserved file
+    """
+
+    def __init__(self, action, journal_path, num_threads=8, quarantine_dir=None):
+        if action not in DELETE_ACTIONS:
+            raise ValueError("Unknown delete action: {}".format(action))
+        if action == 'quarantine' and not quarantine_dir:
+            raise ValueError("quarantine_dir is required for the quarantine action")
+        self.action = action
+        self.quarantine_dir = quarantine_dir
+        self.journal = DeleteJournal(journal_path)
+        self.executor = ThreadPoolExecutor(max(num_threads, 1))
+        self.pending = threading.BoundedSemaphore(max(num_threads, 1) * MAX_PENDING_PER_THREAD)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def submit(self, path, keep=None):
+        # keep is the preserved file of the set, the target of hardlink and reflink
+        self.pending.acquire()
+        try:
+            self.executor.submit(self.run, path, keep).add_done_callback(lambda _future: self.pending.release())
+        except BaseException:
+            self.pending.release()
+            raise
+
+
+    def run(self, path, keep):
+        # absolute paths in the journal, so it can be undone from any directory
+        path = os.path.abspath(path)
+        target = os.path.abspath(keep) if keep is not None else None
+        if self.action == 'quarantine':
+            target = quarantine_path(self.quarantine_dir, path)
+        self.journal.write('begin', self.action, path, target)
+        try:
+            if self.action == 'delete':
+                os.remove(path)
+            elif self.action == 'quarantine':
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # rename never copies, a quarantine on another filesystem is an error
+                os.rename(path, target)
+            elif keep is None:
+                raise ValueError("no preserved file in the set to link to")
+            elif self.action == 'hardlink':
+                replace_with(path, lambda tmp_path: os.link(target, tmp_path))
+            else:
+                replace_with(path, lambda tmp_path: reflink(target, tmp_path))
+        except FileNotFoundError as e:
+            logger.error(e)
+            self.finish('missing', path, target)
+        except (OSError, ValueError) as e:
+            if isinstance(e, OSError) and e.errno == errno.EXDEV:
+                logger.error("Error: {} is not on the same filesystem as {}".format(path, target))
+            else:
+                logger.error("Error: unable to {} {}: {}".format(self.action, path, e))
+            self.finish('error', path, target, str(e))
+        else:
+            self.finish('done', path, target)
+
+
+    def finish(self, status, path, target, error=None):
+        self.journal.write(status, self.action, path, target, error)
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+
+    def close(self):
+        # wait for the submitted actions
+        self.executor.shutdown(wait=True)
+        self.journal.close()
+
+
+def undo_journal(journal_path):
+    # move quarantined files of a journal back, newest first. Return the number of
+    # restored files and the entries which cannot be undone.
+    restored = 0
+    not_undone = []
+    for entry in reversed(read_journal(journal_path)):
+        if entry['action'] != 'quarantine':
+            if entry['status'] == 'done':
+                not_undone.append(entry)
+            continue
+        # an interrupted move has only its 'begin' entry
+        if entry['status'] not in ('begin', 'done'):
+            continue
+        if not os.path.lexists(entry['target']):
+            # restored already when the file is back at its path
+            if not os.path.lexists(entry['path']):
+                logger.error("Error: {} not found, {} not restored".format(entry['target'], entry['path']))
+                not_undone.append(entry)
+            continue
+        if os.path.lexists(entry['path']):
+            logger.error("Error: {} exists, not restored from {}".format(entry['path'], entry['target']))
+            not_undone.append(entry)
+            continue
+        os.makedirs(os.path.dirname(os.path.abspath(entry['path'])), exist_ok=True)
+        os.rename(entry['target'], entry['path'])
+        restored += 1
+    return restored, not_undone
@@ -0,0 +1,78 @@
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# bytes of the full content digest stored in the hash cache (blake2b)
+DIGEST_BYTES = 16
+
+# bytes read from the head of a file for the partial digest
+PARTIAL_BYTES = 64 * 1024
+
+READ_BYTES = 1024 * 1024
+
+
+def partial_digest(filename):
+    # digest of the head of a file, only used to rule out files of the same size
+    with open(filename, 'rb') as f:
+        data = f.read(PARTIAL_BYTES)
+    if xxhash is not None:
+        return xxhash.xxh3_64_digest(data)
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+
+def full_digest(filename):
+    h = hashlib.blake2b(digest_size=DIGEST_BYTES)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_BYTES), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+def try_digest(digest, filename):
+    try:
+        return digest(filename)
+    except OSError:
+        return None
+
+
+def find_digests(size_groups, known, executor=None):
+    # Return {filename: full digest} of files which can have byte-identical copies.
+    # size_groups is a list of (size, filenames of that size), known is {filename: full
+    # digest} of already digested files. Only files whose head is the same as another
+    # file of the same size are digested fully.
+    def digest_map(digest, filenames):
+        if executor is None:
+            return [try_digest(digest, f) for f in filenames]
+        return list(executor.map(lambda f: try_digest(digest, f), filenames))
+
+    digests = {}
+    targets = []
+    for size, filenames in size_groups:
+        unknown = [f for f in filenames if f not in known]
+        digests.update((f, known[f]) for f in filenames if f in known)
+        if len(unknown) < len(filenames) or size <= PARTIAL_BYTES:
+            # compared with known digests, or the head is the whole file
+            targets.extend(unknown)
+            continue
+        heads = {}
+        for filename, head in zip(unknown, digest_map(partial_digest, unknown)):
+            if head is not None:
+                heads.setdefault(head, []).append(filename)
+        targets.extend(f for same_head in heads.values() if len(same_head) > 1 for f in same_head)
+    for filename, digest in zip(targets, digest_map(full_digest, targets)):
+        if digest is not None:
+            digests[filename] = digest
+    return digests
+
+
+def group_by_content(sizes, digests):
+    # return lists of byte-identical filenames from {filename: size} and {filename: digest}
+    groups = {}
+    for filename, digest in digests.items():
+        groups.setdefault((sizes[filename], digest), []).append(filename)
+    return [sorted(filenames) for filenames in groups.values() if len(filenames) > 1]
+
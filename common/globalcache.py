@@ -0,0 +1,73 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from pathlib import Path
+
+import os
+import sqlite3
+import numpy
+
+
+# number of filenames looked up by one query
+LOOKUP_CHUNK_SIZE = 500
+
+
+class GlobalHashCache:
+    """Hash cache shared by all runs, keyed by absolute path, hash method and hash bits.
+
+    A cached hash is only used when the size, mtime, inode and device of the file are
+    unchanged, so runs over subdirectories, parent directories or other file lists can
+    reuse hashes calculated by any earlier run.
+    """
+
+    def __init__(self, cache_dir):
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.path = str(Path(cache_dir) / 'hashes.sqlite')
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            path TEXT NOT NULL,
+            hash_method TEXT NOT NULL,
+            hash_bits INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            dev INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            hash BLOB,
+            PRIMARY KEY (path, hash_method, hash_bits))""")
+        self.conn.commit()
+
+
+    def lookup(self, hash_method, hash_bits, filenames, stats):
+        # return {index of filenames: packed hash or None for failed images} of valid entries
+        abs_paths = [os.path.abspath(f) for f in filenames]
+        index = {path: i for i, path in enumerate(abs_paths)}
+        found = {}
+        for start in range(0, len(abs_paths), LOOKUP_CHUNK_SIZE):
+            chunk = abs_paths[start:start + LOOKUP_CHUNK_SIZE]
+            query = """SELECT path, size, mtime_ns, inode, dev, failed, hash FROM hashes
+                WHERE hash_method = ? AND hash_bits = ? AND path IN ({})""".format(','.join('?' * len(chunk)))
+            for path, size, mtime_ns, inode, dev, failed, hsh in self.conn.execute(query, [hash_method, hash_bits] + chunk):
+                i = index[path]
+                if tuple(stats[i]) == (size, mtime_ns, inode, dev):
+                    found[i] = None if failed else numpy.frombuffer(hsh, dtype=numpy.uint8).copy()
+        return found
+
+
+    def store(self, hash_method, hash_bits, filenames, stats, hashes):
+        rows = []
+        for filename, stat, hsh in zip(filenames, stats, hashes):
+            if stat[0] < 0:
+                # stat unknown, the entry could never be validated
+                continue
+            rows.append((os.path.abspath(filename), hash_method, hash_bits,
+                int(stat[0]), int(stat[1]), int(stat[2]), int(stat[3]),
+                1 if hsh is None else 0, None if hsh is None else bytes(hsh)))
+        self.conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
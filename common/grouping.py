@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def compress(parent):
+    # pointer jumping until every node points to its root
+    while True:
+        grand_parent = parent[parent]
+        if np.array_equal(grand_parent, parent):
+            return parent
+        parent = grand_parent
+
+
+def connected_components(num_nodes, src, dst):
+    # Array-backed union-find. Each component is labeled with its smallest node.
+    parent = np.arange(num_nodes)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    nodes = np.unique(np.concatenate([src, dst]))
+    while len(src) > 0:
+        root_src, root_dst = parent[src], parent[dst]
+        low = np.minimum(root_src, root_dst)
+        high = np.maximum(root_src, root_dst)
+        linked = low != high
+        if not linked.any():
+            break
+        # hook the larger root under the smallest root it is linked with
+        np.minimum.at(parent, high[linked], low[linked])
+        parent = compress(parent)
+        # edges inside a finished component are never needed again
+        src, dst = src[linked], dst[linked]
+    labels = np.full(num_nodes, -1, dtype=np.int64)
+    labels[nodes] = parent[nodes]
+    return labels
+
+
+def star_clusters(num_nodes, src, dst):
+    # Visit nodes in ascending order. A node which is not grouped yet becomes the
+    # representative of a new group with all of its neighbors which are not grouped yet,
+    # so every member is within the radius of its representative.
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+    order = np.lexsort((dst, src))
+    src, dst = src[order], dst[order]
+    bounds = np.searchsorted(src, np.arange(num_nodes + 1))
+    labels = np.full(num_nodes, -1, dtype=np.int64)
+    for i in np.unique(src):
+        if labels[i] >= 0:
+            # already grouped node
+            continue
+        neighbors = dst[bounds[i]:bounds[i + 1]]
+        neighbors = neighbors[labels[neighbors] < 0]
+        if len(neighbors) > 0:
+            labels[i] = i
+            labels[neighbors] = i
+    return labels
+
+
+def group_pairs(num_nodes, src, dst, method='star', rank=None):
+    # Group nodes connected by (src, dst) pairs and return a list of groups, each a list of
+    # nodes with the representative first. Nodes are ordered by rank (default: node index),
+    # which makes the result independent of the order of nodes and pairs.
+    if rank is None:
+        rank = np.arange(num_nodes)
+    by_rank = np.argsort(rank, kind='stable')
+    src = np.asarray(rank)[np.asarray(src, dtype=np.int64)]
+    dst = np.asarray(rank)[np.asarray(dst, dtype=np.int64)]
+    if method == 'components':
+        labels = connected_components(num_nodes, src, dst)
+    elif method == 'star':
+        labels = star_clusters(num_nodes, src, dst)
+    else:
+        raise ValueError("Unknown grouping method: {}".format(method))
+
+    members = np.nonzero(labels >= 0)[0]
+    members = members[np.argsort(labels[members], kind='stable')]
+    splits = np.nonzero(np.diff(labels[members]))[0] + 1
+    return [by_rank[group].tolist() for group in np.split(members, splits) if len(group) > 0]
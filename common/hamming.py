@@ -0,0 +1,187 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from concurrent.futures import ThreadPoolExecutor
+
+import math
+import numpy as np
+
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# number of bytes of XORed hashes processed at once by each thread
+BLOCK_BYTES = 32 * 1024 * 1024
+
+# minimum substring length of the multi-index prefilter
+PREFILTER_MIN_SUBSTRING_BITS = 16
+
+# use the prefilter while each query is expected to look at less than this fraction of hashes
+PREFILTER_MAX_SELECTIVITY = 0.25
+
+# maximum number of substring table lookups per query of the prefilter
+PREFILTER_MAX_LOOKUPS = 4096
+
+
+def popcount_rows(x):
+    # number of set bits in each row of a packed uint8 matrix
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x).sum(axis=-1, dtype=np.uint32)
+    return POPCOUNT_TABLE[x].sum(axis=-1, dtype=np.uint32)
+
+
+def hamming_distances(a, b):
+    # Hamming distances between every row of packed a (n, bytes) and packed b (m, bytes)
+    return popcount_rows(a[:, None, :] ^ b[None, :, :])
+
+
+def pair_distances(data, src, dst):
+    return popcount_rows(data[src] ^ data[dst])
+
+
+def chunk_ranges(total, size):
+    for start in range(0, total, size):
+        yield start, min(start + size, total)
+
+
+def concat_pairs(results):
+    # concatenate a list of (src, dst, distance) tuples
+    if len(results) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+    src, dst, dist = zip(*results)
+    return (np.concatenate(src).astype(np.int64),
+            np.concatenate(dst).astype(np.int64),
+            np.concatenate(dist).astype(np.uint32))
+
+
+def thread_map(executor, num_threads, func, items):
+    # map on the shared executor when given, otherwise on a temporary one
+    if executor is not None:
+        return list(executor.map(func, items))
+    with ThreadPoolExecutor(num_threads) as temporary_executor:
+        return list(temporary_executor.map(func, items))
+
+
+class PopcountIndex:
+    """Exact Hamming distance search over packed hashes using XOR and popcount."""
+
+    def __init__(self, packed_hshs, hash_bits, num_threads=1, executor=None):
+        self.data = np.ascontiguousarray(packed_hshs, dtype=np.uint8)
+        self.num_elements, self.hash_bytes = self.data.shape
+        self.hash_bits = hash_bits
+        self.num_candidates = 0
+        self.num_threads = max(num_threads, 1)
+        self.executor = executor
+        self.block_size = max(int(np.sqrt(BLOCK_BYTES / max(self.hash_bytes, 1))), 1)
+
+
+    def range_search(self, packed_query, radius):
+        # return (labels, distances) of every hash within radius from a single packed query
+        labels = []
+        distances = []
+        for start, end in chunk_ranges(self.num_elements, self.block_size ** 2):
+            dist = popcount_rows(self.data[start:end] ^ packed_query)
+            found = np.nonzero(dist <= radius)[0]
+            labels.append(found + start)
+            distances.append(dist[found])
+        labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+        distances = np.concatenate(distances) if distances else np.zeros(0, dtype=np.uint32)
+        order = np.lexsort((labels, distances))
+        return labels[order], distances[order]
+
+
+    def all_pairs(self, radius):
+        # return (src, dst, distance) of every pair src < dst within radius
+        num_substrings = self.prefilter_substrings(radius)
+        if num_substrings is None:
+            return self.brute_force_pairs(radius)
+        # Pigeonhole prefilter: split hashes into bit substrings and only verify pairs
+        # sharing a substring within radius // num_substrings (see common.mih).
+        from common.mih import MultiIndexHashing
+        mih_index = MultiIndexHashing(self.data, self.hash_bits, radius,
+            num_substrings=num_substrings, num_threads=self.num_threads, executor=self.executor)
+        pairs = mih_index.all_pairs()
+        self.num_candidates += mih_index.num_candidates
+        logger.debug("popcount prefilter candidates: {}".format(mih_index.num_candidates))
+        return pairs
+
+
+    def query_pairs(self, rows, radius):
+        # return (src, dst, distance) of every hash within radius from the hashes at rows,
+        # each pair once (src is in rows)
+        rows = np.asarray(rows, dtype=np.int64)
+        is_query = np.zeros(self.num_elements, dtype=bool)
+        is_query[rows] = True
+        block = self.block_size
+
+        def search_block(start_end):
+            start, end = start_end
+            results = []
+            for other_start, other_end in chunk_ranges(self.num_elements, block):
+                dist = hamming_distances(self.data[rows[start:end]], self.data[other_start:other_end])
+                s, d = np.nonzero(dist <= radius)
+                dist = dist[s, d]
+                s, d = rows[start:end][s], d + other_start
+                keep = (s < d) | ~is_query[d]
+                results.append((s[keep], d[keep], dist[keep]))
+            return concat_pairs(results)
+
+        results = thread_map(self.executor, self.num_threads, search_block, chunk_ranges(len(rows), block))
+        return concat_pairs(results)
+
+
+    def prefilter_substrings(self, radius):
+        # number of substrings for the prefilter, or None when a brute force search is cheaper
+        num_substrings = min(radius + 1, self.hash_bits // PREFILTER_MIN_SUBSTRING_BITS)
+        if num_substrings < 1:
+            return None
+        substring_radius = radius // num_substrings
+        selectivity = 0.0
+        total_lookups = 0
+        for substring in np.array_split(np.arange(self.hash_bits), num_substrings):
+            length = len(substring)
+            lookups = sum(math.comb(length, r) for r in range(min(substring_radius, length) + 1))
+            selectivity += lookups / 2 ** length
+            total_lookups += lookups
+        if selectivity >= PREFILTER_MAX_SELECTIVITY or total_lookups > PREFILTER_MAX_LOOKUPS:
+            return None
+        return num_substrings
+
+
+    def verify_pairs(self, src, dst, radius):
+        chunk = self.block_size ** 2
+
+        def verify(start_end):
+            start, end = start_end
+            s, d = src[start:end], dst[start:end]
+            dist = pair_distances(self.data, s, d)
+            found = dist <= radius
+            return s[found], d[found], dist[found]
+
+        results = thread_map(self.executor, self.num_threads, verify, chunk_ranges(len(src), chunk))
+        return concat_pairs(results)
+
+
+    def brute_force_pairs(self, radius):
+        block = self.block_size
+
+        def search_block(start_end):
+            start, end = start_end
+            results = []
+            for other_start, other_end in chunk_ranges(self.num_elements, block):
+                if other_end <= start:
+                    continue
+                dist = hamming_distances(self.data[start:end], self.data[other_start:other_end])
+                s, d = np.nonzero(dist <= radius)
+                s, d = s + start, d + other_start
+                upper = s < d
+                s, d = s[upper], d[upper]
+                results.append((s, d, dist[s - start, d - other_start]))
+            return concat_pairs(results)
+
+        results = thread_map(self.executor, self.num_threads, search_block, chunk_ranges(self.num_elements, block))
+        return concat_pairs(results)
@@ -7,116 +7,655 @@ logger.addHandler(handler)
 logger.propagate = False
 
 
-from multiprocessing import cpu_count
 from pathlib import Path
 from PIL import Image, ImageFile
 
 import imagehash
 import joblib
+import math
+import os
+import collections
 import sys
+import time
 import numpy
+import scipy.fftpack
 
+from common.batchhash import BATCH_METHODS, batch_hash, resize_gray
 from common.spinner import Spinner
+from common.hashstore import HashStore
+from common.digest import DIGEST_BYTES, find_digests, group_by_content
+from common.workers import Workers
+from common.runstats import RunStats
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+CACHE_VERSION = 3
+
+# hashes are flushed to the hash cache every CHECKPOINT_FILES files or CHECKPOINT_SECONDS seconds
+CHECKPOINT_FILES = 10000
+CHECKPOINT_SECONDS = 300
+
+# number of files sent to a hashing process at once
+HASH_CHUNKSIZE = 16
+
+# number of chunks which can wait for each hashing process
+MAX_CHUNKS_PER_PROC = 4
+
+# number of discovered files looked up in the global cache at once
+SCAN_BATCH_SIZE = 256
+
+# with fast decode, images are decoded at least this many times larger than the hash input
+FAST_DECODE_SCALE = 4
+
+# columns of HashCache.stat_matrix, -1 when unknown
+STAT_FIELDS = ('size', 'mtime_ns', 'inode', 'dev')
+UNKNOWN_STAT = (-1, -1, -1, -1)
+
+# columns of HashCache.dim_matrix, -1 when unknown and 0 when the image cannot be decoded
+DIM_FIELDS = ('width', 'height')
+UNKNOWN_DIMS = (-1, -1)
+
+
+def stat_file(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+    except OSError:
+        return UNKNOWN_STAT
+
+
+# attributes used only while update_hash_dict runs
+UPDATE_STATE = ('update_workers', 'spinner', 'in_flight', 'results', 'last_checkpoint',
+                'cached_stats', 'cached_failed', 'stat_names', 'trusted', 'modified', 'deferred', 'same_size')
+
 
 class HashCache:
-    def __init__(self, args, image_filenames, hash_method, hash_size, num_proc, load_path=None):
+    def __init__(self, args, image_filenames, hash_method, hash_size, num_proc, load_path=None, global_cache=None, extra_hashes=(),
+                 fast_decode=False, checkpoint_files=CHECKPOINT_FILES, checkpoint_seconds=CHECKPOINT_SECONDS, workers=None, stats=None):
         self.args = args
         self.image_filenames = image_filenames
+        self.hash_method = hash_method
+        self.global_cache = global_cache
+        self.fast_decode = fast_decode
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_seconds = checkpoint_seconds
+        # shared Workers, a temporary one is used by update_hash_dict when not given
+        self.workers = workers
+        # RunStats of the run, shared with the extra caches
+        self.stats = stats if stats is not None else RunStats()
+        self.hasher_copy = None
+        # where update_hash_dict checkpoints the hashes, set by load_hash_dict
+        self.dump_path = None
+        # caches of additional (hash_method, hash_size) calculated from the same image decode
+        self.extra_caches = [HashCache(args, image_filenames, method, size, num_proc, global_cache=global_cache, fast_decode=fast_decode,
+            stats=self.stats) for method, size in extra_hashes]
         self.hashfunc = self.gen_hashfunc(hash_method)
         self.hash_size = hash_size
         self.hash_bits = hash_size ** 2
+        self.hash_bytes = (self.hash_bits + 7) // 8
         self.num_proc = num_proc
-        self.hash_dict = {}
+        # packed hashes: one row of hash_bytes per file, parallel to filename_list
+        self.filename_list = []
+        self.hash_matrix = numpy.zeros((0, self.hash_bytes), dtype=numpy.uint8)
+        self.failed = numpy.zeros(0, dtype=bool)
+        self.stat_matrix = numpy.zeros((0, len(STAT_FIELDS)), dtype=numpy.int64)
+        # full content digests, all zeros when unknown
+        self.digest_matrix = numpy.zeros((0, DIGEST_BYTES), dtype=numpy.uint8)
+        # image dimensions recorded while hashing
+        self.dim_matrix = numpy.zeros((0, len(DIM_FIELDS)), dtype=numpy.int32)
+        self.stored_filenames = None
+        self.modified = set()
+        # files hashed (or whose hashes were found in the global cache) by the last update
+        self.added = set()
+
+
+    def __getstate__(self):
+        # the global cache connection, the workers and the state of an update are not
+        # sent to worker processes
+        state = self.__dict__.copy()
+        for name in UPDATE_STATE:
+            state.pop(name, None)
+        state['global_cache'] = None
+        state['workers'] = None
+        state['stats'] = None
+        state['image_filenames'] = []
+        return state
 
 
     def __len__(self):
-        return len(self.cache)
+        # number of searchable hashes, same as len(filenames())
+        return int(numpy.count_nonzero(~self.failed))
 
 
     def hshs(self):
-        return list(self.hash_dict.values())
+        # unpacked 0/1 vectors for ANN backends which do not understand packed bits
+        return self.unpack(self.packed_hshs())
+
+
+    def packed_hshs(self):
+        return self.hash_matrix[~self.failed]
 
 
     def filenames(self):
-        return list(self.hash_dict.keys())
+        return [f for f, failed in zip(self.filename_list, self.failed) if not failed]
+
+
+    def unpack(self, packed):
+        return numpy.unpackbits(packed, axis=-1, count=self.hash_bits)
 
 
     def gen_hash(self, img):
+        hashes, _dims = self.gen_hashes([(img, (True,))])[0]
+        return hashes[0]
+
+
+    def hash_file(self, filename):
+        # hash a single file (e.g. a query) in the shared hashing processes
+        return self.hash_files([filename])[0]
+
+
+    def hash_files(self, filenames):
+        # packed hashes (None for failed images) of query files, spread over the hashing processes
+        if self.workers is None:
+            return [self.gen_hash(filename) for filename in filenames]
+        tasks = [(filename, (True,)) for filename in filenames]
+        chunksize = max(-(-len(tasks) // self.workers.num_proc), 1)
+        chunks = [self.workers.hash_async(self.hasher(), tasks[start:start + chunksize])
+            for start in range(0, len(tasks), chunksize)]
+        return [hashes[0] for chunk in chunks for _filename, _wanted, hashes, _dims in chunk.get()]
+
+
+    def hasher(self):
+        # copy of this cache without any hashes, sent once to each hashing process
+        if self.hasher_copy is None:
+            self.hasher_copy = HashCache(None, [], self.hash_method, self.hash_size, 1,
+                extra_hashes=[(hashcache.hash_method, hashcache.hash_size) for hashcache in self.extra_caches],
+                fast_decode=self.fast_decode)
+        return self.hasher_copy
+
+
+    def gen_hashes(self, tasks):
+        # Decode each image and convert it to grayscale once, and resize it to the input of
+        # every wanted hash of this cache and the extra caches. The inputs of each cache are
+        # stacked and hashed at once by batch_hash (whash image by image).
+        # Return (hashes, (width, height)) for each (filename, wanted) task.
+        caches = [self] + self.extra_caches
+        hashes = [[None] * len(caches) for _ in tasks]
+        dims = [(0, 0)] * len(tasks)
+        inputs = [([], []) for _ in caches]
+        for task_index, (img, wanted) in enumerate(tasks):
+            try:
+                with Image.open(img) as i:
+                    # dimensions of the original image, before draft mode changes them
+                    size = i.size
+                    if self.fast_decode:
+                        gray = self.reduce_image(i, [c for c, want in zip(caches, wanted) if want]).convert("L")
+                    else:
+                        gray = i.convert("L")
+            except:
+                continue
+            dims[task_index] = size
+            for cache_index, (hashcache, want) in enumerate(zip(caches, wanted)):
+                if not want:
+                    continue
+                if hashcache.hash_method not in BATCH_METHODS:
+                    hashes[task_index][cache_index] = hashcache.hash_image(gray)
+                    continue
+                try:
+                    pixels = resize_gray(gray, hashcache.hash_method, hashcache.hash_size)
+                except:
+                    continue
+                inputs[cache_index][0].append(task_index)
+                inputs[cache_index][1].append(pixels)
+        for cache_index, (hashcache, (task_indices, pixels)) in enumerate(zip(caches, inputs)):
+            if len(pixels) == 0:
+                continue
+            packed = batch_hash(hashcache.hash_method, numpy.stack(pixels), hashcache.hash_size)
+            for task_index, hsh in zip(task_indices, packed):
+                hashes[task_index][cache_index] = hsh
+        return list(zip(hashes, dims))
+
+
+    def decode_size(self):
+        # smallest image size the hash function resizes from, None if it needs the full image
+        if self.hash_method in ('ahash', 'dhash'):
+            return self.hash_size + 1
+        elif self.hash_method in ('phash', 'phash_org'):
+            return self.hash_size * 4
+        # whash chooses its scale from the size of the image
+        return None
+
+
+    def reduce_image(self, image, caches):
+        # Decode JPEG images at reduced size with DCT scaling (draft mode), and shrink
+        # other large images with a cheap box reduce before the hash function resizes them.
+        sizes = [hashcache.decode_size() for hashcache in caches]
+        if len(sizes) == 0 or None in sizes:
+            return image
+        size = FAST_DECODE_SCALE * max(sizes)
+        if image.format == 'JPEG':
+            image.draft('L', (size, size))
+        factor = min(image.size) // size
+        if factor >= 2:
+            image = image.reduce(factor)
+        return image
+
+
+    def decode_drift(self, filenames):
+        # Hamming distances between hashes of full decode and fast decode, -1 for failed images
+        full = HashCache(None, [], self.hash_method, self.hash_size, 1)
+        fast = HashCache(None, [], self.hash_method, self.hash_size, 1, fast_decode=True)
+        distances = []
+        for filename in filenames:
+            full_hsh, fast_hsh = full.gen_hash(filename), fast.gen_hash(filename)
+            if full_hsh is None or fast_hsh is None:
+                distances.append(-1)
+            else:
+                distances.append(int(numpy.unpackbits(full_hsh ^ fast_hsh).sum()))
+        return numpy.array(distances, dtype=numpy.int64)
+
+
+    def hash_image(self, image):
+        # hash of a single image by the reference hash function of hash_method
         try:
-            with Image.open(img) as i:
-                hsh = self.hashfunc(i, hash_size=self.hash_size)
-                hsh = numpy.array([ 1 if b else 0 for b in hsh.hash.reshape((self.hash_bits))])
+            hsh = self.hashfunc(image, hash_size=self.hash_size)
+            hsh = numpy.packbits(hsh.hash.reshape((self.hash_bits)))
         except:
-            hsh = numpy.array([2] * self.hash_bits)
+            hsh = None
         return hsh
 
 
-    def make_hash_list(self):
-        if self.num_proc is None:
-            self.num_proc = cpu_count() - 1
+    def append_hashes(self, filenames, hashes, stats, dims=None):
+        failed = numpy.array([hsh is None for hsh in hashes], dtype=bool)
+        rows = numpy.zeros((len(hashes), self.hash_bytes), dtype=numpy.uint8)
+        for row, hsh in enumerate(hashes):
+            if hsh is not None:
+                rows[row] = hsh
+        if dims is None:
+            dims = [UNKNOWN_DIMS] * len(hashes)
+        self.append_rows(filenames, rows, failed, stats, numpy.zeros((len(hashes), DIGEST_BYTES), dtype=numpy.uint8), dims)
+
+
+    def append_rows(self, filenames, hashes, failed, stats, digests, dims):
+        self.filename_list.extend(filenames)
+        self.hash_matrix = numpy.concatenate([self.hash_matrix, numpy.asarray(hashes, dtype=numpy.uint8).reshape(-1, self.hash_bytes)])
+        self.failed = numpy.concatenate([self.failed, numpy.asarray(failed, dtype=bool)])
+        self.stat_matrix = numpy.concatenate([self.stat_matrix, numpy.asarray(stats, dtype=numpy.int64).reshape(-1, len(STAT_FIELDS))])
+        self.digest_matrix = numpy.concatenate([self.digest_matrix, numpy.asarray(digests, dtype=numpy.uint8).reshape(-1, DIGEST_BYTES)])
+        self.dim_matrix = numpy.concatenate([self.dim_matrix, numpy.asarray(dims, dtype=numpy.int32).reshape(-1, len(DIM_FIELDS))])
+
+
+    def remove_hashes(self, filenames):
+        keep = numpy.array([f not in filenames for f in self.filename_list], dtype=bool)
+        self.filename_list = [f for f, k in zip(self.filename_list, keep) if k]
+        self.hash_matrix = self.hash_matrix[keep]
+        self.failed = self.failed[keep]
+        self.stat_matrix = self.stat_matrix[keep]
+        self.digest_matrix = self.digest_matrix[keep]
+        self.dim_matrix = self.dim_matrix[keep]
+
+
+    def known_digests(self, current_stats):
+        # {filename: full content digest} of the files whose digest is in the cache and whose
+        # cached stat equals the current one, so files modified in place are digested again
+        rows = numpy.nonzero(self.digest_matrix.any(axis=1))[0]
+        digests = {}
+        for row in rows:
+            filename = self.filename_list[row]
+            if filename not in self.modified and tuple(self.stat_matrix[row].tolist()) == current_stats.get(filename):
+                digests[filename] = self.digest_matrix[row].tobytes()
+        return digests
+
+
+    def set_digests(self, digests):
+        # store {filename: full content digest}, return whether any digest was new
+        changed = False
+        for row, filename in enumerate(self.filename_list):
+            digest = digests.get(filename)
+            if digest is not None:
+                digest = numpy.frombuffer(digest, dtype=numpy.uint8)
+                if (self.digest_matrix[row] != digest).any():
+                    self.digest_matrix[row] = digest
+                    changed = True
+        return changed
+
+
+    def image_info(self):
+        # {filename: (file size, width, height)}, -1 when unknown
+        return {filename: (size, width, height) for filename, size, (width, height)
+            in zip(self.filename_list, self.stat_matrix[:, 0].tolist(), self.dim_matrix.tolist())}
+
+
+    def exact_groups(self):
+        # lists of byte-identical files (same size and full content digest) among the searchable hashes
+        rows = numpy.nonzero(self.digest_matrix.any(axis=1) & ~self.failed)[0]
+        groups = {}
+        for row in rows:
+            key = (int(self.stat_matrix[row, 0]), self.digest_matrix[row].tobytes())
+            groups.setdefault(key, []).append(self.filename_list[row])
+        return sorted(sorted(filenames) for filenames in groups.values() if len(filenames) > 1)
+
+
+    def fresh_row(self, index, filenames):
+        # row of the first file whose hash is up to date, None if there is no such file
+        for filename in filenames:
+            if filename in index and filename not in self.modified:
+                return index[filename]
+        return None
+
+
+    def begin_update(self):
+        # snapshot of the cache to classify files while they are discovered
+        self.cached_stats = {f: tuple(stat) for f, stat in zip(self.filename_list, self.stat_matrix.tolist())}
+        self.stat_names = {stat: f for f, stat in self.cached_stats.items() if stat[0] >= 0}
+        self.cached_failed = {f for f, failed in zip(self.filename_list, self.failed.tolist()) if failed}
+        self.trusted = {}
+        self.modified = set()
+        self.deferred = []
+        self.added = set()
+
+
+    def classify(self, filename, stat):
+        # return whether a discovered file has to be hashed
+        cached_stat = self.cached_stats.get(filename)
+        if cached_stat is None:
+            if stat in self.stat_names:
+                # possibly moved, resolved by finish_update when all files are discovered
+                self.deferred.append(filename)
+                return False
+            return True
+        elif cached_stat == UNKNOWN_STAT:
+            if filename in self.cached_failed:
+                # failed without a stat, e.g. a path which did not exist yet
+                self.modified.add(filename)
+                return True
+            # stat unknown (cache of older versions), trust the cached hash
+            self.trusted[filename] = stat
+            return False
+        elif cached_stat == stat:
+            return False
+        # file was modified in place
+        self.modified.add(filename)
+        return True
+
+
+    def finish_update(self, current_stats):
+        # Remove lost files and rename moved files (same inode, size and mtime) in place
+        # after all files are discovered.
+        # Return (filenames still to hash, whether the cache was changed).
+        changed = len(self.trusted) > 0
+        if len(self.trusted) > 0:
+            index = {f: row for row, f in enumerate(self.filename_list)}
+            for filename, stat in self.trusted.items():
+                self.stat_matrix[index[filename]] = stat
+
+        lost_set = set(self.cached_stats) - set(current_stats)
+        lost_names = {}
+        for filename in self.filename_list:
+            if filename in lost_set and self.cached_stats[filename][0] >= 0:
+                lost_names[self.cached_stats[filename]] = filename
+        renames = {}
+        target_files = []
+        for filename in self.deferred:
+            lost_name = lost_names.pop(current_stats[filename], None)
+            if lost_name is None:
+                target_files.append(filename)
+            else:
+                logger.debug("Moved: {} -> {}".format(lost_name, filename))
+                renames[lost_name] = filename
+        if len(renames) > 0:
+            self.filename_list = [renames.get(f, f) for f in self.filename_list]
+            lost_set -= set(renames)
+            changed = True
+        if len(lost_set) > 0:
+            self.remove_hashes(lost_set)
+            changed = True
+        return target_files, changed
+
 
+    def update_hash_dict(self):
+        with self.stats.stage('hash'):
+            if self.workers is not None:
+                return self.update_hashes(self.workers)
+            with Workers(self.num_proc) as workers:
+                return self.update_hashes(workers)
+
+
+    def update_hashes(self, workers):
+        # Hash files while they are discovered. self.image_filenames can be any iterable,
+        # e.g. a directory scanner, and is replaced with the list of discovered files.
+        caches = [self] + self.extra_caches
+        for hashcache in caches:
+            hashcache.begin_update()
+        current_stats = {}
+        self.update_workers = workers
+        self.spinner = None
+        self.in_flight = collections.deque()
+        self.results = []
+        self.last_checkpoint = time.time()
+        # files of a size already seen are hashed after byte-identical files are found
+        self.same_size = []
+        sizes = set()
+        updated = False
         try:
-            spinner = Spinner(prefix="Calculating image hashes (hash-bits={} num-proc={})...".format(self.hash_bits, self.num_proc))
-            spinner.start()
-            from multiprocessing import Pool
-            pool = Pool(self.num_proc)
-            self.cache = pool.map(self.gen_hash, self.image_filenames)
-            spinner.stop()
+            batch = []
+            for filename in self.image_filenames:
+                if filename in current_stats:
+                    continue
+                stat = stat_file(filename)
+                if stat == UNKNOWN_STAT:
+                    # a missing path (e.g. in --files-from) is not stored, it is hashed once it exists
+                    continue
+                current_stats[filename] = stat
+                wanted = tuple(hashcache.classify(filename, stat) for hashcache in caches)
+                self.stats.count('cache_misses' if any(wanted) else 'cache_hits')
+                if any(wanted) and stat[0] in sizes:
+                    self.same_size.append((filename, wanted))
+                elif any(wanted):
+                    batch.append((filename, wanted))
+                sizes.add(stat[0])
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    updated = self.submit_hash_tasks(batch, current_stats) or updated
+                    batch = []
+                    self.collect_hash_results(current_stats, block=False)
+            updated = self.submit_hash_tasks(batch, current_stats) or updated
+
+            # files which turned out not to be moved
+            wanted = {}
+            for i, hashcache in enumerate(caches):
+                target_files, changed = hashcache.finish_update(current_stats)
+                updated = changed or updated
+                for filename in target_files:
+                    wanted.setdefault(filename, [False] * len(caches))[i] = True
+            updated = self.submit_hash_tasks([(f, tuple(w)) for f, w in wanted.items()], current_stats) or updated
+
+            self.collect_hash_results(current_stats, block=True)
+            self.checkpoint(self.results, current_stats, dump=False)
+            self.results = []
+            with self.stats.stage('byte_duplicates'):
+                updated = self.hash_byte_duplicates(current_stats) or updated
         except KeyboardInterrupt:
-            pool.terminate()
-            pool.join()
-            spinner.stop()
+            workers.terminate()
+            # keep the hashes calculated so far, the next run resumes from them
+            self.checkpoint(self.results, current_stats)
             sys.exit(1)
-
-
-    def update_hash_dict(self):
-        if self.num_proc is None:
-            self.num_proc = cpu_count() - 1
-
-        # check current hash_dict
-        current_files = set(self.image_filenames)
-        cache_files = self.hash_dict.keys()
-        lost_set = cache_files - current_files
-        target_files = list(current_files - cache_files)
-
-        if len(lost_set) + len(target_files) > 0:
-            try:
-                if len(self.hash_dict) == 0:
-                    spinner = Spinner(prefix="Calculating image hashes (hash-bits={} num-proc={})...".format(self.hash_bits, self.num_proc))
-                else:
-                    spinner = Spinner(prefix="Updating image hashes (hash-bits={} num-proc={})...".format(self.hash_bits, self.num_proc))
-                spinner.start()
-
-                # del lost_set from hash_dict
-                for f in lost_set:
-                    del self.hash_dict[f]
-
-                from multiprocessing import Pool
-                pool = Pool(self.num_proc)
-                hashes = pool.map(self.gen_hash, target_files)
-                for filename, hash_value in zip(target_files, hashes):
-                    self.hash_dict[filename] = hash_value
-                spinner.stop()
-            except KeyboardInterrupt:
-                pool.terminate()
-                pool.join()
-                spinner.stop()
-                sys.exit(1)
-            return True
-        else:
+        finally:
+            if self.spinner is not None:
+                self.spinner.stop()
+
+        for hashcache in caches:
+            hashcache.image_filenames = list(current_stats)
+        return updated
+
+
+    def hash_byte_duplicates(self, current_stats):
+        # Find byte-identical files among files of the same size, and copy the hashes of a
+        # file to its copies instead of decoding them again. Full content digests are
+        # stored in the caches. Return whether any cache was changed.
+        caches = [self] + self.extra_caches
+        size_files = {}
+        for filename, stat in current_stats.items():
+            if stat[0] >= 0:
+                size_files.setdefault(stat[0], []).append(filename)
+        size_groups = [(size, filenames) for size, filenames in size_files.items() if len(filenames) > 1]
+        if len(size_groups) == 0:
+            return False
+        digests = find_digests(size_groups, self.known_digests(current_stats), executor=self.update_workers.threads())
+        groups = group_by_content({f: current_stats[f][0] for f in digests}, digests)
+        group_of = {f: group for group in groups for f in group}
+
+        # one file of each group is hashed when no file of the group has a hash yet
+        indexes = [{f: row for row, f in enumerate(hashcache.filename_list)} for hashcache in caches]
+        tasks = []
+        copies = []
+        leaders = set()
+        for filename, wanted in self.same_size:
+            group = group_of.get(filename)
+            if group is None:
+                tasks.append((filename, wanted))
+                continue
+            copies.append((filename, wanted, group))
+            if group[0] in leaders:
+                continue
+            missing = tuple(want and hashcache.fresh_row(index, group) is None
+                for hashcache, index, want in zip(caches, indexes, wanted))
+            if any(missing):
+                leaders.add(group[0])
+                tasks.append((filename, missing))
+        updated = self.submit_hash_tasks(tasks, current_stats)
+        self.collect_hash_results(current_stats, block=True)
+        self.checkpoint(self.results, current_stats, dump=False)
+        self.results = []
+        self.stats.count('digested_files', len(digests))
+        self.stats.count('byte_identical_copies', len(copies))
+        if len(copies) > 0:
+            logger.debug("Copy hashes of {} byte-identical files".format(len(copies)))
+
+        for i, hashcache in enumerate(caches):
+            index = {f: row for row, f in enumerate(hashcache.filename_list)}
+            done = []
+            for filename, wanted, group in copies:
+                if not wanted[i] or hashcache.fresh_row(index, [filename]) is not None:
+                    continue
+                row = hashcache.fresh_row(index, group)
+                if row is not None:
+                    done.append((filename, None if hashcache.failed[row] else hashcache.hash_matrix[row].copy(),
+                        tuple(hashcache.dim_matrix[row])))
+            hashcache.add_hashes([filename for filename, _hsh, _dims in done], [hsh for _filename, hsh, _dims in done],
+                [current_stats[filename] for filename, _hsh, _dims in done], [dims for _filename, _hsh, dims in done])
+            updated = len(done) > 0 or updated
+            updated = hashcache.set_digests(digests) or updated
+        return updated
+
+
+    def submit_hash_tasks(self, tasks, current_stats):
+        # send (filename, wanted) tasks to the hashing processes after reusing hashes of the
+        # global cache, return whether any hash was added or is being calculated
+        if len(tasks) == 0:
             return False
+        caches = [self] + self.extra_caches
+        wanted = {filename: list(want) for filename, want in tasks}
+        for i, hashcache in enumerate(caches):
+            target_files = [filename for filename, want in tasks if want[i]]
+            remaining = set(hashcache.reuse_global_hashes(target_files, current_stats))
+            for filename in target_files:
+                wanted[filename][i] = filename in remaining
+        tasks = [(filename, tuple(want)) for filename, want in wanted.items() if any(want)]
+        if len(tasks) == 0:
+            return True
+
+        workers = self.update_workers
+        if self.spinner is None:
+            if len(self.filename_list) == 0:
+                self.spinner = Spinner(prefix="Calculating image hashes (hash-bits={} num-proc={})...".format(self.hash_bits, workers.num_proc))
+            else:
+                self.spinner = Spinner(prefix="Updating image hashes (hash-bits={} num-proc={})...".format(self.hash_bits, workers.num_proc))
+            self.spinner.start()
+        # small batches are spread over all processes, and a chunk never delays a checkpoint
+        chunksize = max(min(HASH_CHUNKSIZE, -(-len(tasks) // workers.num_proc), self.checkpoint_files), 1)
+        for start in range(0, len(tasks), chunksize):
+            # bound the number of chunks waiting for hashing processes
+            while len(self.in_flight) >= workers.num_proc * MAX_CHUNKS_PER_PROC:
+                self.results.extend(self.in_flight.popleft().get())
+                self.maybe_checkpoint(current_stats)
+            self.in_flight.append(workers.hash_async(self.hasher(), tasks[start:start + chunksize]))
+        return True
+
+
+    def collect_hash_results(self, current_stats, block):
+        while len(self.in_flight) > 0 and (block or self.in_flight[0].ready()):
+            self.results.extend(self.in_flight.popleft().get())
+            self.maybe_checkpoint(current_stats)
+
+
+    def maybe_checkpoint(self, current_stats):
+        if (len(self.results) >= self.checkpoint_files
+                or time.time() - self.last_checkpoint >= self.checkpoint_seconds):
+            self.checkpoint(self.results, current_stats)
+            self.results = []
+            self.last_checkpoint = time.time()
+
+
+    def checkpoint(self, results, current_stats, dump=True):
+        # add (filename, wanted, hashes, dims) results of hashing processes to the caches, and write
+        # them to the hash caches on disk so that an interrupted run can resume
+        results = sorted(results, key=lambda result: result[0])
+        self.stats.items('hash', len(results))
+        self.stats.count('hashed_files', len(results))
+        self.stats.count('failed_files', sum(1 for _filename, _wanted, hashes, _dims in results if all(hsh is None for hsh in hashes)))
+        self.stats.count('bytes_hashed', sum(max(current_stats[filename][0], 0) for filename, _wanted, _hashes, _dims in results))
+        for i, hashcache in enumerate([self] + self.extra_caches):
+            done = [(filename, hashes[i], dims) for filename, wanted, hashes, dims in results if wanted[i]]
+            hashcache.add_hashes([filename for filename, _hsh, _dims in done], [hsh for _filename, hsh, _dims in done],
+                [current_stats[filename] for filename, _hsh, _dims in done], [dims for _filename, _hsh, dims in done])
+            if dump and hashcache.dump_path is not None:
+                hashcache.dump_hash_dict(hashcache.dump_path, True)
+
+
+    def global_cache_method(self):
+        # hashes of fast decode are stored apart from those of full decode
+        return self.hash_method + ':fast' if self.fast_decode else self.hash_method
+
+
+    def reuse_global_hashes(self, target_files, current_stats):
+        # append hashes calculated by other runs and return target files still to be hashed
+        if self.global_cache is None or len(target_files) == 0:
+            return target_files
+        target_stats = [current_stats[f] for f in target_files]
+        found = self.global_cache.lookup(self.global_cache_method(), self.hash_bits, target_files, target_stats)
+        if len(found) == 0:
+            return target_files
+        logger.debug("Found {} hashes in the global cache".format(len(found)))
+        self.stats.count('global_cache_hits', len(found))
+        rows = sorted(found.keys())
+        self.replace_hashes([target_files[row] for row in rows], [found[row] for row in rows], [target_stats[row] for row in rows])
+        return [f for row, f in enumerate(target_files) if row not in found]
+
+
+    def add_hashes(self, target_files, hashes, target_stats, target_dims=None):
+        if len(target_files) == 0:
+            return
+        self.replace_hashes(target_files, hashes, target_stats, target_dims)
+        if self.global_cache is not None:
+            self.global_cache.store(self.global_cache_method(), self.hash_bits, target_files, target_stats, hashes)
+
+
+    def replace_hashes(self, filenames, hashes, stats, dims=None):
+        # rows of files modified in place are replaced by their new hashes
+        stale = self.modified.intersection(filenames)
+        if len(stale) > 0:
+            self.remove_hashes(stale)
+            self.modified -= stale
+        self.append_hashes(filenames, hashes, stats, dims)
+        self.added.update(filenames)
 
 
     def phash_org(self, image, hash_size=8, highfreq_factor=4):
         if hash_size < 2:
                 raise ValueError("Hash size must be greater than or equal to 2")
 
-        import scipy.fftpack
         img_size = hash_size * highfreq_factor
-        image = image.convert("L").resize((img_size, img_size), Image.ANTIALIAS)
+        image = image.convert("L").resize((img_size, img_size), Image.LANCZOS)
         pixels = numpy.asarray(image)
         dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)
         # using only the 8x8 DCT low-frequency values and excluding the first term since the DC coefficient
@@ -128,6 +667,7 @@ class HashCache:
 
 
     def gen_hashfunc(self, hash_method):
+        hashfunc = None
         if hash_method == 'ahash':
             hashfunc = imagehash.average_hash
         elif hash_method == 'phash':
@@ -141,25 +681,207 @@ class HashCache:
         return hashfunc
 
 
-    def load_hash_dict(self, load_path, use_cache, target_dir):
-        if load_path and Path(load_path).exists() and use_cache:
+    def load_hash_dict(self, load_path, use_cache, target_dir, extra_load_paths=(), merge_paths=(), extra_merge_paths=()):
+        # load_path is a HashStore directory, a hash cache dumped by older versions
+        # (load_path + '.dump') is converted to it. Cache shards at merge_paths (one list
+        # for each extra cache in extra_merge_paths) are merged before updating.
+        is_current = self.load_cache_data(load_path, use_cache)
+        for hashcache, extra_load_path in zip(self.extra_caches, extra_load_paths):
+            is_current = hashcache.load_cache_data(extra_load_path, use_cache) and is_current
+        if len(merge_paths) > 0:
+            with self.stats.stage('cache_merge'):
+                num_merged = self.merge_stores(merge_paths)
+                for hashcache, paths in zip(self.extra_caches, extra_merge_paths):
+                    num_merged += hashcache.merge_stores(paths)
+            self.stats.count('merged_hashes', num_merged)
+            logger.warning("Merged {} hashes from {} cache shards".format(num_merged, len(merge_paths)))
+            is_current = is_current and num_merged == 0
+        is_update = self.update_hash_dict()
+        # rewrite caches stored in the old format even if nothing changed
+        return is_current and not is_update
+
+
+    def load_cache_data(self, load_path, use_cache):
+        self.set_cache_data({})
+        is_current = False
+        self.dump_path = load_path if load_path and use_cache else None
+        if self.dump_path is None:
+            return is_current
+        store = HashStore(load_path, self.hash_bits, len(STAT_FIELDS))
+        legacy_path = "{}.dump".format(load_path)
+        if store.exists():
             logger.debug("Load hash cache: {}".format(load_path))
             spinner = Spinner(prefix="Loading hash cache...")
             spinner.start()
-            self.hash_dict = joblib.load(load_path)
+            with self.stats.stage('cache_load'):
+                is_current = self.load_store(store)
             spinner.stop()
-            is_update = self.update_hash_dict()
-            return not is_update
-        else:
-            self.hash_dict = {}
-            self.update_hash_dict()
+        elif Path(legacy_path).exists():
+            logger.debug("Load hash cache: {}".format(legacy_path))
+            spinner = Spinner(prefix="Loading hash cache...")
+            spinner.start()
+            with self.stats.stage('cache_load'):
+                self.set_cache_data(joblib.load(legacy_path))
+            spinner.stop()
+        return is_current
+
+
+    def merge_stores(self, load_paths):
+        # Add the hashes of cache shards, which can be written by other hosts (see --shard).
+        # Inode and device numbers differ between hosts mounting the same storage, so a row
+        # is kept with the local stat when the size and mtime of the local file match.
+        # Return the number of merged rows.
+        known = set(self.filename_list)
+        num_merged = 0
+        for load_path in load_paths:
+            loaded = HashStore(load_path, self.hash_bits, len(STAT_FIELDS)).load()
+            if loaded is None:
+                logger.warning("Skip cache shard of another hash: {}".format(load_path))
+                continue
+            filenames, hashes, failed, stats, digests, dims, _num_rows = loaded
+            rows = []
+            local_stats = []
+            for row, filename in enumerate(filenames):
+                if filename in known:
+                    continue
+                stat = stat_file(filename)
+                if stat[0] >= 0 and stat[:2] == tuple(stats[row][:2]):
+                    rows.append(row)
+                    local_stats.append(stat)
+            rows = numpy.array(rows, dtype=numpy.int64)
+            self.append_rows([filenames[row] for row in rows], hashes[rows], failed[rows], local_stats, digests[rows], dims[rows])
+            known.update(filenames[row] for row in rows)
+            num_merged += len(rows)
+        return num_merged
+
+
+    def load_store(self, store):
+        loaded = store.load()
+        if loaded is None:
             return False
-
-
-    def dump_hash_dict(self, dump_path, use_cache):
+        filenames, hashes, failed, stats, digests, dims, num_rows = loaded
+        self.filename_list = list(filenames)
+        self.hash_matrix = hashes
+        self.failed = numpy.array(failed, dtype=bool)
+        self.stat_matrix = numpy.array(stats, dtype=numpy.int64)
+        self.digest_matrix = numpy.array(digests, dtype=numpy.uint8)
+        self.dim_matrix = numpy.array(dims, dtype=numpy.int32)
+        self.set_stored_state(num_rows)
+        return True
+
+
+    def set_stored_state(self, num_rows):
+        # remember what is on disk, so that only the changes are written by dump_hash_dict
+        self.stored_filenames = list(self.filename_list)
+        self.stored_hashes = self.hash_matrix
+        self.stored_failed = self.failed.copy()
+        self.stored_stats = self.stat_matrix.copy()
+        self.stored_digests = self.digest_matrix.copy()
+        self.stored_dims = self.dim_matrix.copy()
+        self.stored_rows = num_rows
+
+
+    def set_cache_data(self, data):
+        self.filename_list = []
+        self.hash_matrix = numpy.zeros((0, self.hash_bytes), dtype=numpy.uint8)
+        self.failed = numpy.zeros(0, dtype=bool)
+        self.stat_matrix = numpy.zeros((0, len(STAT_FIELDS)), dtype=numpy.int64)
+        self.digest_matrix = numpy.zeros((0, DIGEST_BYTES), dtype=numpy.uint8)
+        self.dim_matrix = numpy.zeros((0, len(DIM_FIELDS)), dtype=numpy.int32)
+        if data.get('version') in (2, CACHE_VERSION):
+            if data['hash_bits'] == self.hash_bits:
+                self.filename_list = list(data['filenames'])
+                self.hash_matrix = data['hashes']
+                self.failed = data['failed']
+                self.stat_matrix = data.get('stats', numpy.full((len(self.filename_list), len(STAT_FIELDS)), -1, dtype=numpy.int64))
+                self.digest_matrix = data.get('digests', numpy.zeros((len(self.filename_list), DIGEST_BYTES), dtype=numpy.uint8))
+                self.dim_matrix = data.get('dims', numpy.full((len(self.filename_list), len(DIM_FIELDS)), -1, dtype=numpy.int32))
+                return data['version'] == CACHE_VERSION
+        elif len(data) > 0:
+            # hash cache dumped by older versions: {filename: array of 0/1 (2 for failed)}
+            rows = numpy.array(list(data.values()))
+            if rows.ndim == 2 and rows.shape[1] == self.hash_bits:
+                failed = (rows == 2).any(axis=1)
+                self.filename_list = list(data.keys())
+                self.hash_matrix = numpy.packbits(rows == 1, axis=1)
+                self.hash_matrix[failed] = 0
+                self.failed = failed
+                self.stat_matrix = numpy.full((len(self.filename_list), len(STAT_FIELDS)), -1, dtype=numpy.int64)
+                self.digest_matrix = numpy.zeros((len(self.filename_list), DIGEST_BYTES), dtype=numpy.uint8)
+                self.dim_matrix = numpy.full((len(self.filename_list), len(DIM_FIELDS)), -1, dtype=numpy.int32)
+        return False
+
+
+    def get_cache_data(self):
+        return {
+            'version': CACHE_VERSION,
+            'hash_bits': self.hash_bits,
+            'filenames': self.filename_list,
+            'hashes': self.hash_matrix,
+            'failed': self.failed,
+            'stats': self.stat_matrix,
+            'digests': self.digest_matrix,
+            'dims': self.dim_matrix,
+        }
+
+
+    def dump_hash_dict(self, dump_path, use_cache, extra_dump_paths=()):
+        with self.stats.stage('cache_dump'):
+            return self.dump_hash_store(dump_path, use_cache, extra_dump_paths)
+
+
+    def dump_hash_store(self, dump_path, use_cache, extra_dump_paths=()):
+        for hashcache, extra_dump_path in zip(self.extra_caches, extra_dump_paths):
+            hashcache.dump_hash_store(extra_dump_path, use_cache)
         if use_cache:
-            joblib.dump(self.hash_dict, dump_path, protocol=2, compress=True)
+            store = HashStore(dump_path, self.hash_bits, len(STAT_FIELDS))
+            if self.stored_filenames is not None and store.exists():
+                self.append_store(store)
+            else:
+                store.write(self.filename_list, self.hash_matrix, self.failed, self.stat_matrix, self.digest_matrix, self.dim_matrix)
+                self.set_stored_state(len(self.filename_list))
             logger.debug("Dump hash cache: {}".format(dump_path))
             return True
         else:
             return False
+
+
+    def append_store(self, store):
+        # write the entries added or changed since the store was loaded as a new segment
+        stored_index = {f: row for row, f in enumerate(self.stored_filenames)}
+        stored_rows = numpy.array([stored_index.get(f, -1) for f in self.filename_list], dtype=numpy.int64)
+        changed = stored_rows < 0
+        known = numpy.nonzero(~changed)[0]
+        rows = stored_rows[known]
+        changed[known] = ((self.stored_hashes[rows] != self.hash_matrix[known]).any(axis=1)
+            | (self.stored_stats[rows] != self.stat_matrix[known]).any(axis=1)
+            | (self.stored_digests[rows] != self.digest_matrix[known]).any(axis=1)
+            | (self.stored_dims[rows] != self.dim_matrix[known]).any(axis=1)
+            | (self.stored_failed[rows] != self.failed[known]))
+        deleted = list(set(self.stored_filenames) - set(self.filename_list))
+        changed_rows = numpy.nonzero(changed)[0]
+        num_rows = self.stored_rows + len(changed_rows)
+        if len(changed_rows) + len(deleted) == 0:
+            return
+        if store.append_will_compact(num_rows, len(self.filename_list)):
+            store.write(self.filename_list, self.hash_matrix, self.failed, self.stat_matrix, self.digest_matrix, self.dim_matrix)
+            num_rows = len(self.filename_list)
+        else:
+            store.append([self.filename_list[row] for row in changed_rows], self.hash_matrix[changed_rows],
+                self.failed[changed_rows], self.stat_matrix[changed_rows], self.digest_matrix[changed_rows],
+                self.dim_matrix[changed_rows], deleted)
+        self.set_stored_state(num_rows)
+
+
+def convert_hash_cache(dump_path):
+    # convert a hash cache dumped by older versions to a HashStore directory next to it
+    data = joblib.load(dump_path)
+    if 'hash_bits' in data:
+        hash_bits = data['hash_bits']
+    else:
+        hash_bits = len(next(iter(data.values()), []))
+    hashcache = HashCache(None, [], None, int(math.sqrt(hash_bits)), 1)
+    hashcache.set_cache_data(data)
+    store_path = str(Path(dump_path).with_suffix(''))
+    hashcache.dump_hash_dict(store_path, True)
+    return store_path, len(hashcache.filename_list)
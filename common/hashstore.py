@@ -0,0 +1,180 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from pathlib import Path
+
+import json
+import os
+import numpy
+
+from common.digest import DIGEST_BYTES
+
+
+STORE_VERSION = 1
+
+# compact the store when it has more segments than this
+MAX_SEGMENTS = 16
+
+
+class HashStore:
+    """On-disk hash cache made of append-only segments.
+
+    The store is a directory. Each segment has a fixed-width hash matrix which is loaded
+    with numpy.memmap, a stat table, a failed flag table, a content digest table, an image
+    dimension table, a NUL separated filename table and a table of filenames deleted by
+    the segment. Segments are applied in order and later entries override earlier ones with the same filename. meta.json lists the
+    valid segments, so a segment is only used once it has been completely written.
+    """
+
+    def __init__(self, path, hash_bits, num_stat_fields):
+        self.path = Path(path)
+        self.hash_bits = hash_bits
+        self.hash_bytes = (hash_bits + 7) // 8
+        self.num_stat_fields = num_stat_fields
+
+
+    def exists(self):
+        return (self.path / 'meta.json').exists()
+
+
+    def read_meta(self):
+        with open(self.path / 'meta.json', 'r') as f:
+            return json.load(f)
+
+
+    def write_meta(self, segments):
+        meta = {'version': STORE_VERSION, 'hash_bits': self.hash_bits, 'segments': segments}
+        tmp_path = self.path / 'meta.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path / 'meta.json')
+
+
+    def segment_path(self, segment, suffix):
+        return self.path / "{}.{}".format(segment, suffix)
+
+
+    def read_names(self, segment, suffix):
+        data = self.segment_path(segment, suffix).read_bytes()
+        if len(data) == 0:
+            return []
+        return [os.fsdecode(name) for name in data.split(b'\0')]
+
+
+    def write_names(self, segment, suffix, names):
+        with open(self.segment_path(segment, suffix), 'wb') as f:
+            f.write(b'\0'.join(os.fsencode(name) for name in names))
+
+
+    def read_segment(self, segment):
+        filenames = self.read_names(segment, 'names')
+        if len(filenames) > 0:
+            hashes = numpy.memmap(self.segment_path(segment, 'hashes'), dtype=numpy.uint8, mode='r',
+                shape=(len(filenames), self.hash_bytes))
+        else:
+            hashes = numpy.zeros((0, self.hash_bytes), dtype=numpy.uint8)
+        stats = numpy.load(self.segment_path(segment, 'stats.npy'))
+        failed = numpy.load(self.segment_path(segment, 'failed.npy'))
+        digest_path = self.segment_path(segment, 'digests.npy')
+        if digest_path.exists():
+            digests = numpy.load(digest_path)
+        else:
+            # segments written before digests were stored
+            digests = numpy.zeros((len(filenames), DIGEST_BYTES), dtype=numpy.uint8)
+        dims_path = self.segment_path(segment, 'dims.npy')
+        if dims_path.exists():
+            dims = numpy.load(dims_path)
+        else:
+            # segments written before image dimensions were stored
+            dims = numpy.full((len(filenames), 2), -1, dtype=numpy.int32)
+        deleted = self.read_names(segment, 'deleted')
+        return filenames, hashes, failed, stats, digests, dims, deleted
+
+
+    def write_segment(self, segment, filenames, hashes, failed, stats, digests, dims, deleted):
+        numpy.ascontiguousarray(hashes, dtype=numpy.uint8).tofile(str(self.segment_path(segment, 'hashes')))
+        numpy.save(self.segment_path(segment, 'stats.npy'), numpy.asarray(stats, dtype=numpy.int64))
+        numpy.save(self.segment_path(segment, 'failed.npy'), numpy.asarray(failed, dtype=bool))
+        numpy.save(self.segment_path(segment, 'digests.npy'), numpy.asarray(digests, dtype=numpy.uint8))
+        numpy.save(self.segment_path(segment, 'dims.npy'), numpy.asarray(dims, dtype=numpy.int32))
+        self.write_names(segment, 'deleted', deleted)
+        # the filename table is written last, it defines the number of rows
+        self.write_names(segment, 'names', filenames)
+
+
+    def load(self):
+        # return (filenames, hashes, failed, stats, digests, dims, number of rows in all segments)
+        meta = self.read_meta()
+        if meta.get('version') != STORE_VERSION or meta.get('hash_bits') != self.hash_bits:
+            return None
+        segments = [self.read_segment(segment) for segment in meta['segments']]
+        num_rows = sum(len(s[0]) for s in segments)
+        if len(segments) == 1 and len(segments[0][6]) == 0:
+            # a compacted store is used as it is without copying the hash matrix
+            filenames, hashes, failed, stats, digests, dims, _deleted = segments[0]
+            return filenames, hashes, failed, stats, digests, dims, num_rows
+
+        # resolve segments: later entries override earlier ones
+        location = {}
+        for seg_index, (filenames, _hashes, _failed, _stats, _digests, _dims, deleted) in enumerate(segments):
+            for filename in deleted:
+                location.pop(filename, None)
+            for row, filename in enumerate(filenames):
+                location.pop(filename, None)
+                location[filename] = (seg_index, row)
+        filenames = list(location.keys())
+        seg_rows = numpy.array(list(location.values()), dtype=numpy.int64).reshape(-1, 2)
+        hashes = numpy.zeros((len(filenames), self.hash_bytes), dtype=numpy.uint8)
+        failed = numpy.zeros(len(filenames), dtype=bool)
+        stats = numpy.zeros((len(filenames), self.num_stat_fields), dtype=numpy.int64)
+        digests = numpy.zeros((len(filenames), DIGEST_BYTES), dtype=numpy.uint8)
+        dims = numpy.zeros((len(filenames), 2), dtype=numpy.int32)
+        for seg_index, (_filenames, seg_hashes, seg_failed, seg_stats, seg_digests, seg_dims, _deleted) in enumerate(segments):
+            target = numpy.nonzero(seg_rows[:, 0] == seg_index)[0]
+            rows = seg_rows[target, 1]
+            hashes[target] = seg_hashes[rows]
+            failed[target] = seg_failed[rows]
+            stats[target] = seg_stats[rows]
+            digests[target] = seg_digests[rows]
+            dims[target] = seg_dims[rows]
+        return filenames, hashes, failed, stats, digests, dims, num_rows
+
+
+    def next_segment_name(self, segments):
+        number = max([int(s.split('_')[1]) for s in segments] + [0]) + 1
+        return "seg_{:06d}".format(number)
+
+
+    def append_will_compact(self, num_rows, num_live_rows):
+        # compact instead of appending when there are too many segments or overridden rows
+        num_segments = len(self.read_meta()['segments']) + 1
+        return num_segments > MAX_SEGMENTS or num_rows > 2 * max(num_live_rows, 1)
+
+
+    def append(self, filenames, hashes, failed, stats, digests, dims, deleted):
+        # write only the changed entries as a new segment
+        self.path.mkdir(parents=True, exist_ok=True)
+        segments = self.read_meta()['segments'] if self.exists() else []
+        segment = self.next_segment_name(segments)
+        self.write_segment(segment, filenames, hashes, failed, stats, digests, dims, deleted)
+        self.write_meta(segments + [segment])
+        return len(segments) + 1
+
+
+    def write(self, filenames, hashes, failed, stats, digests, dims):
+        # write all entries as a single segment and remove the other segments
+        self.path.mkdir(parents=True, exist_ok=True)
+        segments = self.read_meta()['segments'] if self.exists() else []
+        segment = self.next_segment_name(segments)
+        self.write_segment(segment, filenames, hashes, failed, stats, digests, dims, [])
+        self.write_meta([segment])
+        for path in self.path.glob('seg_*'):
+            if not path.name.startswith(segment + '.'):
+                path.unlink()
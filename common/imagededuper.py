@@ -8,7 +8,6 @@ logger.propagate = False
 
 from builtins import input
 from datetime import datetime
-from multiprocessing import cpu_count
 from operator import itemgetter
 from pathlib import Path
 from PIL import Image
@@ -23,12 +22,24 @@ import math
 import GPUtil
 import numpy as np
 
-from common.imgcatutil import imgcat_for_iTerm2, create_tile_img
+from common.imgcatutil import imgcat_for_iTerm2, create_tile_img, ThumbnailCache, TilePrefetcher
 from common.hashcache import HashCache
+from common.globalcache import GlobalHashCache
+from common.hamming import PopcountIndex, chunk_ranges, concat_pairs
+from common.mih import MultiIndexHashing
+from common.annindex import AnnIndex
+from common.outofcore import OutOfCoreIndex
+from common.grouping import group_pairs
+from common.workers import Workers
+from common.runstats import RunStats
+from common.deleter import DeleteExecutor
 
 
 class ImageDeduper:
-    def __init__(self, args, image_filenames):
+    def __init__(self, args, image_filenames, workers=None, stats=None):
+        # processes and threads shared by hashing, query and search stages
+        self.workers = workers if workers is not None else Workers(args.num_proc)
+        self.stats = stats if stats is not None else RunStats()
         self.target_dir = args.target_dir
         self.files_from = args.files_from
         self.recursive = args.recursive
@@ -39,6 +50,15 @@ class ImageDeduper:
         self.hash_method = args.hash_method
         self.hamming_distance = args.hamming_distance
         self.cache = args.cache
+        self.cache_dir = args.cache_dir
+        self.fast_decode = args.fast_decode
+        self.exact_only = args.exact_only
+        self.only_new = args.only_new
+        # (index, count) of the cache shard written by this run, or None
+        self.shard = args.shard
+        self.merge_shards = args.merge_shards
+        self.engine = args.engine
+        self.grouping = args.grouping
         self.ngt = args.ngt
         self.hnsw = args.hnsw
         self.faiss_flat = args.faiss_flat
@@ -57,56 +77,116 @@ class ImageDeduper:
                                "{}".format(self.cuda_device), 'red'))
         self.hash_size = self.get_hash_size()
         self.cleaned_target_dir = self.get_valid_filename()
-        self.duplicate_filesize_dict = {}
-        self.hashcache = HashCache(args, self.image_filenames, self.hash_method, self.hash_size, args.num_proc)
+        # (filesize, width, height) of images, filled from the hash cache at first use
+        self.image_info = None
+        self.extra_hashes = [(method, bits) for method, bits in args.extra_hashes
+            if (method, bits) != (self.hash_method, self.hash_bits)]
+        global_cache = GlobalHashCache(self.cache_dir) if self.cache and self.cache_dir else None
+        self.hashcache = HashCache(args, self.image_filenames, self.hash_method, self.hash_size, self.workers.num_proc,
+            global_cache=global_cache, extra_hashes=[(method, int(math.sqrt(bits))) for method, bits in self.extra_hashes],
+            fast_decode=self.fast_decode, checkpoint_files=args.checkpoint_files, checkpoint_seconds=args.checkpoint_seconds,
+            workers=self.workers, stats=self.stats)
         self.group = {}
         self.num_duplicate_set = 0
 
 
-    def get_valid_filename(self):
+    def get_valid_filename(self, absolute=False):
         if self.files_from:
-            path = str(self.files_from).strip().replace(' ', '_').replace('.', '_')
+            files_from = os.path.abspath(self.files_from) if absolute else self.files_from
+            path = str(files_from).strip().replace(' ', '_').replace('.', '_')
         else:
-            path = str(self.target_dir).strip().replace(' ', '_')
+            target_dir = os.path.abspath(self.target_dir) if absolute else self.target_dir
+            path = str(target_dir).strip().replace(' ', '_')
         return re.sub(r'(?u)[^-\w.]', '', path)
 
 
-    def get_hashcache_dump_name(self):
-        return "hash_cache_{}_{}_{}.dump".format(self.cleaned_target_dir, self.hash_method, self.hash_bits)
+    def get_hashcache_dump_name(self, hash_method=None, hash_bits=None, shard=None):
+        hash_method = hash_method or self.hash_method
+        hash_bits = hash_bits or self.hash_bits
+        shard = shard or self.shard
+        suffix = "_fast" if self.fast_decode else ""
+        if shard:
+            suffix += "_shard_{}_of_{}".format(*shard)
+        if self.cache_dir:
+            # caches of all working directories share cache_dir, so they are named by absolute path
+            name = "hash_cache_{}_{}_{}{}".format(self.get_valid_filename(absolute=True), hash_method, hash_bits, suffix)
+            return os.path.join(self.cache_dir, name)
+        return "hash_cache_{}_{}_{}{}".format(self.cleaned_target_dir, hash_method, hash_bits, suffix)
+
+
+    def get_extra_hashcache_dump_names(self):
+        return [self.get_hashcache_dump_name(method, bits) for method, bits in self.extra_hashes]
+
+
+    def get_shard_dump_names(self, hash_method=None, hash_bits=None):
+        return [self.get_hashcache_dump_name(hash_method, hash_bits, (index, self.merge_shards))
+            for index in range(self.merge_shards)]
 
 
     def get_duplicate_log_name(self):
-        if self.ngt:
-            return "dup_ngt_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        elif self.hnsw:
-            return "dup_hnsw_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        elif self.faiss_flat:
-            return "dup_faiss_flat_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        else:
-            return "dup_std_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
+        if self.exact_only:
+            return "dup_exact_{}.log".format(self.cleaned_target_dir)
+        return "dup_{}_{}_{}_{}_{}.log".format(self.engine.replace('-', '_'), self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
 
 
     def get_delete_log_name(self):
-        if self.ngt:
-            return "del_ngt_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        elif self.hnsw:
-            return "del_hnsw_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        elif self.faiss_flat:
-            return "del_faiss_flat_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
-        else:
-            return "del_std_{}_{}_{}_{}.log".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
+        if self.exact_only:
+            return "del_exact_{}.log".format(self.cleaned_target_dir)
+        return "del_{}_{}_{}_{}_{}.log".format(self.engine.replace('-', '_'), self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
+
+
+    def get_delete_journal_name(self):
+        name = self.get_delete_log_name().replace('del_', 'journal_', 1)
+        return "{}_{}".format(datetime.now().strftime('%Y%m%d%H%M%S'), name.replace('.log', '.jsonl'))
 
 
-    def get_ngt_index_path(self):
-        return "ngt_{}_{}_{}_{}.ngt_index".format(self.cleaned_target_dir, self.hash_method, self.hash_bits, self.hamming_distance)
+    def get_ann_index_path(self):
+        # the index is saved next to the hash cache, and only when the hash cache is used
+        if not self.cache:
+            return None
+        return "{}_{}_index".format(self.get_hashcache_dump_name(), self.engine.replace('-', '_'))
 
 
     def load_hashcache(self):
-        return self.hashcache.load_hash_dict(self.get_hashcache_dump_name(), self.cache, self.target_dir)
+        merge_paths = self.get_shard_dump_names()
+        missing = [path for path in merge_paths if not Path(path, 'meta.json').exists()]
+        if len(missing) > 0:
+            logger.error(colored("Error: Cache shards not found: {}".format(", ".join(missing)), 'red'))
+            sys.exit(1)
+        return self.hashcache.load_hash_dict(self.get_hashcache_dump_name(), self.cache, self.target_dir,
+            extra_load_paths=self.get_extra_hashcache_dump_names(), merge_paths=merge_paths,
+            extra_merge_paths=[self.get_shard_dump_names(method, bits) for method, bits in self.extra_hashes])
 
 
     def dump_hashcache(self):
-        return self.hashcache.dump_hash_dict(self.get_hashcache_dump_name(), self.cache)
+        return self.hashcache.dump_hash_dict(self.get_hashcache_dump_name(), self.cache,
+            extra_dump_paths=self.get_extra_hashcache_dump_names())
+
+
+    def report_decode_drift(self, num_samples):
+        # compare hashes of fast decode with those of full decode on sampled images
+        image_filenames = sorted(self.image_filenames)
+        step = max(len(image_filenames) // num_samples, 1)
+        samples = image_filenames[::step][:num_samples]
+        distances = self.hashcache.decode_drift(samples)
+        distances = distances[distances >= 0]
+        if len(distances) == 0:
+            logger.warning(colored("No image could be hashed to check fast decode", 'red'))
+            return
+        within = np.count_nonzero(distances <= self.hamming_distance)
+        print("Fast decode drift of {} (hash-bits={}) on {} images: mean {:.2f} bits, max {} bits, {} images ({:.1f}%) within hamming distance {}".format(
+            self.hash_method, self.hash_bits, len(distances), distances.mean(), distances.max(),
+            within, 100.0 * within / len(distances), self.hamming_distance))
+        for distance, count in zip(*np.unique(distances, return_counts=True)):
+            print("  {:3d} bits: {}".format(distance, count))
+
+
+    def gen_query_hash(self, query):
+        hsh = self.hashcache.hash_file(query)
+        if hsh is None:
+            logger.error(colored("Error: Unable to calculate image hash of query image: {}".format(query), 'red'))
+            sys.exit(1)
+        return self.hashcache.unpack(hsh)
 
 
     def get_hash_size(self):
@@ -160,207 +240,200 @@ class ImageDeduper:
                     sys.stdout.write(error_prompt)
 
 
-    def dedupe(self, args):
-        if not self.load_hashcache():
+    def load_hashes(self, args):
+        # load the hash cache and hash new or changed images
+        is_current = self.load_hashcache()
+        self.image_filenames = self.hashcache.image_filenames
+        if len(self.image_filenames) == 0:
+            logger.error("Image not found. To search the directory recursively, add the --recursive option.")
+            sys.exit(0)
+        if not is_current:
             self.dump_hashcache()
+        if args.fast_decode_report:
+            self.report_decode_drift(args.fast_decode_report)
 
-        # check num_proc
-        if args.num_proc is None:
-            num_proc = max(cpu_count() - 1, 1)
-        else:
-            num_proc = args.num_proc
+
+    def dedupe(self, args):
+        self.load_hashes(args)
+        exact_groups = self.hashcache.exact_groups()
+        logger.warning("Found {} sets of byte-identical images".format(len(exact_groups)))
+
+        num_proc = self.workers.num_proc
+
+        if self.exact_only:
+            # byte-identical images only, without neighbor search
+            for current_group_num, group in enumerate(exact_groups, start=1):
+                self.group[current_group_num] = group
+            current_group_num = len(exact_groups) + 1
 
         # Use NGT by default
-        if (not self.hnsw) and (not self.faiss_flat):
-            try:
-                import ngtpy
-            except:
-                logger.error(colored("Error: Unable to load NGT. Please install NGT and python binding first.", 'red'))
-                sys.exit(1)
-            index_path = self.get_ngt_index_path()
-            logger.warning("Building NGT index (dimension={}, num_proc={})".format(self.hash_bits, num_proc))
-            ngtpy.create(path=index_path.encode(),
-                dimension=self.hash_bits,
-                edge_size_for_creation=args.ngt_edges,
-                edge_size_for_search=args.ngt_edges_for_search,
-                object_type="Byte",
-                distance_type="Hamming")
-            ngt_index = ngtpy.Index(index_path.encode())
-            ngt_index.batch_insert(self.hashcache.hshs(), num_proc)
-
-            # NGT Approximate neighbor search
-            logger.warning("Approximate neighbor searching using NGT")
-            hshs = self.hashcache.hshs()
+        elif self.ngt or self.hnsw or self.faiss_flat:
+            ann_names = {'ngt': 'NGT', 'hnsw': 'hnsw', 'faiss-flat': 'faiss'}
             filenames = self.hashcache.filenames()
-            check_list = [0] * len(hshs)
+            packed_hshs = self.hashcache.packed_hshs()
+            ann_index = AnnIndex(self.engine, self.hash_bits, args, num_proc, path=self.get_ann_index_path(),
+                executor=self.workers.threads(), cuda_device=self.cuda_device if self.faiss_cuda else None)
+            logger.warning("Building {} index (dimension={}, num_proc={})".format(ann_names[self.engine], self.hash_bits, num_proc))
+            with self.stats.stage('index_build'):
+                new_rows = ann_index.sync(filenames, packed_hshs)
+
+            if self.faiss_flat:
+                logger.warning("Exact neighbor searching using faiss")
+            else:
+                logger.warning("Approximate neighbor searching using {}".format(ann_names[self.engine]))
             current_group_num = 1
-            if not args.query:
-                for i in tqdm(range(len(hshs))):
-                    new_group_found = False
-                    if check_list[i] != 0:
-                        # already grouped image
-                        continue
-                    for res in ngt_index.search(hshs[i], size=args.ngt_k, epsilon=args.ngt_epsilon):
-                        if res[0] == i:
-                            continue
-                        else:
-                            if res[1] <= self.hamming_distance:
-                                if check_list[res[0]] == 0:
-                                    if check_list[i] == 0:
-                                        # new group
-                                        new_group_found = True
-                                        check_list[i] = current_group_num
-                                        check_list[res[0]] = current_group_num
-                                        self.group[current_group_num] = [filenames[i]]
-                                        self.group[current_group_num].extend([filenames[res[0]]])
-                                    else:
-                                        # exists group
-                                        exists_group_num = check_list[i]
-                                        check_list[res[0]] = exists_group_num
-                                        self.group[exists_group_num].extend([filenames[res[0]]])
-                    if new_group_found:
-                        current_group_num += 1
+            if not args.query and self.only_new:
+                known_pairs = ann_index.known_pairs()
+                search_rows = np.union1d(self.new_rows(filenames), new_rows)
+                logger.warning("Searching {} new images against {} images".format(len(search_rows), len(filenames)))
+                ann_search = lambda rows: ann_index.search(packed_hshs[rows])
+                src, dst, distances = self.batch_search(ann_search, search_rows, args.query_batch_size)
+                # the saved pairs stay complete when every image not searched now was searched before
+                if known_pairs is not None:
+                    ann_index.save(filenames, packed_hshs, concat_pairs([known_pairs, (src, dst, distances)]))
+                else:
+                    ann_index.save(filenames, packed_hshs)
+                current_group_num = self.group_pairs(filenames, src, dst)
+            elif not args.query:
+                known_pairs = ann_index.known_pairs()
+                if known_pairs is None:
+                    # pairs of the last run are not reusable, search all images
+                    new_rows = np.arange(len(filenames))
+                    known_pairs = concat_pairs([])
+                logger.warning("Searching {} new images of {} images".format(len(new_rows), len(filenames)))
+                ann_search = lambda rows: ann_index.search(packed_hshs[rows])
+                pairs = concat_pairs([known_pairs, self.batch_search(ann_search, new_rows, args.query_batch_size)])
+                ann_index.save(filenames, packed_hshs, pairs)
+                src, dst, _distances = pairs
+                current_group_num = self.group_pairs(filenames, src, dst)
             else: # query image
-                new_group_found = False
-                hsh = self.hashcache.gen_hash(args.query)
-                self.group[current_group_num] = []
-                for res in ngt_index.search(hsh, size=args.ngt_k, epsilon=args.ngt_epsilon):
-                    if res[1] <= self.hamming_distance:
-                        new_group_found = True
-                        self.group[current_group_num].extend([filenames[res[0]]])
-                if new_group_found:
+                # pairs of the last run are kept while no image is left unsearched
+                ann_index.save(filenames, packed_hshs, ann_index.known_pairs() if len(new_rows) == 0 else None)
+                hsh = np.packbits(self.gen_query_hash(args.query))
+                with self.stats.stage('search'):
+                    labels, distances = ann_index.search(hsh.reshape(1, -1))
+                self.stats.count('search_calls')
+                found = [label for label, distance in zip(labels[0], distances[0]) if label >= 0 and distance <= self.hamming_distance]
+                if len(found) > 0:
+                    self.group[current_group_num] = [filenames[label] for label in found]
                     current_group_num += 1
+            ann_index.close()
 
-            # remove ngt index
-            if index_path:
-                os.system("rm -rf {}".format(index_path))
 
-
-        elif self.hnsw:
-            try:
-                import hnswlib
-            except:
-                logger.error(colored("Error: Unable to load hnsw. Please install hnsw python binding first.", 'red'))
-                sys.exit(1)
-            hshs = self.hashcache.hshs()
+        elif self.engine == 'popcount':
             filenames = self.hashcache.filenames()
-            num_elements = len(hshs)
-            hshs_labels = np.arange(num_elements)
-            hnsw_index = hnswlib.Index(space='l2', dim=self.hash_bits) # Squared L2
-            hnsw_index.init_index(max_elements=num_elements, ef_construction=args.hnsw_ef_construction, M=args.hnsw_m)
-            hnsw_index.set_ef(max(args.hnsw_ef, args.hnsw_k - 1)) # ef should always be > k
-            hnsw_index.set_num_threads(num_proc)
-            logger.warning("Building hnsw index (dimension={}, num_proc={})".format(self.hash_bits, num_proc))
-            hnsw_index.add_items(hshs, hshs_labels, num_proc)
-
-            # hnsw Approximate neighbor search
-            logger.warning("Approximate neighbor searching using hnsw")
-            check_list = [0] * num_elements
+            logger.warning("Building popcount index (bits={}, num_proc={})".format(self.hash_bits, num_proc))
+            with self.stats.stage('index_build'):
+                popcount_index = PopcountIndex(self.hashcache.packed_hshs(), self.hash_bits, num_threads=num_proc,
+                    executor=self.workers.threads())
+
+            # popcount Exact neighbor search
+            logger.warning("Exact neighbor searching using popcount")
             current_group_num = 1
-            if not args.query:
-                for i in tqdm(range(num_elements)):
-                    new_group_found = False
-                    if check_list[i] != 0:
-                        # already grouped image
-                        continue
-                    labels, distances = hnsw_index.knn_query(hshs[i], k=args.hnsw_k, num_threads=num_proc)
-                    for label, distance in zip(labels[0], distances[0]):
-                        if label == i:
-                            continue
-                        else:
-                            if distance <= self.hamming_distance:
-                                if check_list[label] == 0:
-                                    if check_list[i] == 0:
-                                        # new group
-                                        new_group_found = True
-                                        check_list[i] = current_group_num
-                                        check_list[label] = current_group_num
-                                        self.group[current_group_num] = [filenames[i]]
-                                        self.group[current_group_num].extend([filenames[label]])
-                                    else:
-                                        # exists group
-                                        exists_group_num = check_list[i]
-                                        check_list[label] = exists_group_num
-                                        self.group[exists_group_num].extend([filenames[label]])
-                    if new_group_found:
-                        current_group_num += 1
+            if not args.query and self.only_new:
+                rows = self.new_rows(filenames)
+                logger.warning("Searching {} new images against {} images".format(len(rows), len(filenames)))
+                with self.stats.stage('search'):
+                    src, dst, _distances = popcount_index.query_pairs(rows, self.hamming_distance)
+                current_group_num = self.group_pairs(filenames, src, dst)
+            elif not args.query:
+                with self.stats.stage('search'):
+                    src, dst, _distances = popcount_index.all_pairs(self.hamming_distance)
+                current_group_num = self.group_pairs(filenames, src, dst)
             else: # query image
-                new_group_found = False
-                hsh = self.hashcache.gen_hash(args.query)
-                self.group[current_group_num] = []
-                labels, distances = hnsw_index.knn_query(hsh, k=args.hnsw_k, num_threads=num_proc)
-                for label, distance in zip(labels[0], distances[0]):
-                    if distance <= self.hamming_distance:
-                        new_group_found = True
-                        self.group[current_group_num].extend([filenames[label]])
-                if new_group_found:
+                hsh = np.packbits(self.gen_query_hash(args.query))
+                with self.stats.stage('search'):
+                    labels, _distances = popcount_index.range_search(hsh, self.hamming_distance)
+                if len(labels) > 0:
+                    self.group[current_group_num] = [filenames[label] for label in labels]
                     current_group_num += 1
+            self.stats.count('search_calls')
+            self.stats.count('candidate_pairs', popcount_index.num_candidates)
 
 
-        elif self.faiss_flat:
-            try:
-                import faiss
-            except:
-                logger.error(colored("Error: Unable to load faiss. Please install faiss python binding first.", 'red'))
-                sys.exit(1)
-            hshs = self.hashcache.hshs()
+        elif self.engine == 'mih':
             filenames = self.hashcache.filenames()
-            faiss.omp_set_num_threads(num_proc)
-            logger.warning("Building faiss index (dimension={}, num_proc={})".format(self.hash_bits, num_proc))
-            data = np.array(hshs).astype('float32')
-            faiss_flat_index = faiss.IndexFlatL2(self.hash_bits)  # Exact search
-            if self.faiss_cuda:
-                res = faiss.StandardGpuResources()
-                faiss_flat_index = faiss.index_cpu_to_gpu(res, self.cuda_device, faiss_flat_index)  # Convert to CUDA
-            faiss_flat_index.add(data)
-
-            # faiss Exact neighbor search
-            logger.warning("Exact neighbor searching using faiss")
-            check_list = [0] * faiss_flat_index.ntotal
+            logger.warning("Building multi-index hashing tables (bits={}, num_proc={})".format(self.hash_bits, num_proc))
+            with self.stats.stage('index_build'):
+                mih_index = MultiIndexHashing(self.hashcache.packed_hshs(), self.hash_bits, self.hamming_distance,
+                    num_substrings=args.mih_substrings, num_threads=num_proc, executor=self.workers.threads())
+
+            # multi-index hashing Exact neighbor search
+            logger.warning("Exact neighbor searching using multi-index hashing (substrings={}, substring radius={})".format(
+                mih_index.num_substrings, mih_index.substring_radius))
             current_group_num = 1
             if not args.query:
-                for i in tqdm(range(faiss_flat_index.ntotal)):
-                    new_group_found = False
-                    if check_list[i] != 0:
-                        # already grouped image
-                        continue
-                    distances, labels = faiss_flat_index.search(data[[i]], args.faiss_flat_k)
-                    for label, distance in zip(labels[0], distances[0]):
-                        if label == i:
-                            continue
-                        else:
-                            if distance <= self.hamming_distance:
-                                if check_list[label] == 0:
-                                    if check_list[i] == 0:
-                                        # new group
-                                        new_group_found = True
-                                        check_list[i] = current_group_num
-                                        check_list[label] = current_group_num
-                                        self.group[current_group_num] = [filenames[i]]
-                                        self.group[current_group_num].extend([filenames[label]])
-                                    else:
-                                        # exists group
-                                        exists_group_num = check_list[i]
-                                        check_list[label] = exists_group_num
-                                        self.group[exists_group_num].extend([filenames[label]])
-                    if new_group_found:
-                        current_group_num += 1
+                if self.only_new:
+                    rows = self.new_rows(filenames)
+                    logger.warning("Searching {} new images against {} images".format(len(rows), len(filenames)))
+                    with self.stats.stage('search'):
+                        src, dst, _distances = mih_index.query_pairs(rows)
+                else:
+                    with self.stats.stage('search'):
+                        src, dst, _distances = mih_index.all_pairs()
+                logger.warning("Verified {} candidate pairs, found {} pairs within Hamming distance {}".format(
+                    mih_index.num_candidates, len(src), self.hamming_distance))
+                current_group_num = self.group_pairs(filenames, src, dst)
+            else: # query image
+                hsh = np.packbits(self.gen_query_hash(args.query))
+                with self.stats.stage('search'):
+                    labels, _distances = mih_index.range_search(hsh)
+                logger.warning("Verified {} candidates, found {} images within Hamming distance {}".format(
+                    mih_index.num_candidates, len(labels), self.hamming_distance))
+                if len(labels) > 0:
+                    self.group[current_group_num] = [filenames[label] for label in labels]
+                    current_group_num += 1
+            self.stats.count('search_calls')
+            self.stats.count('candidate_pairs', mih_index.num_candidates)
+
+
+        elif self.engine == 'outofcore':
+            # rows of the hash cache are searched in place, failed images are skipped
+            filenames = self.hashcache.filename_list
+            logger.warning("Building out-of-core index (bits={}, max_memory={}, num_proc={})".format(
+                self.hash_bits, args.max_memory, num_proc))
+            with self.stats.stage('index_build'):
+                ooc_index = OutOfCoreIndex(self.hashcache.hash_matrix, self.hash_bits, self.hamming_distance, args.max_memory,
+                    valid=~self.hashcache.failed, num_threads=num_proc, executor=self.workers.threads())
+
+            # out-of-core Exact neighbor search
+            if ooc_index.bounds is None:
+                logger.warning("Exact neighbor searching using out-of-core blocks (block size={})".format(ooc_index.block_size))
+            else:
+                logger.warning("Exact neighbor searching using out-of-core substring buckets (substrings={}, buckets={})".format(
+                    len(ooc_index.bounds), ooc_index.num_buckets()))
+            current_group_num = 1
+            if not args.query:
+                if self.only_new:
+                    rows = self.new_rows(filenames)
+                    logger.warning("Searching {} new images against {} images".format(len(rows), len(filenames)))
+                    with self.stats.stage('search'):
+                        src, dst, _distances = ooc_index.query_pairs(rows)
+                else:
+                    with self.stats.stage('search'):
+                        src, dst, _distances = ooc_index.all_pairs()
+                logger.warning("Verified {} candidate pairs, found {} pairs within Hamming distance {}".format(
+                    ooc_index.num_candidates, len(src), self.hamming_distance))
+                current_group_num = self.group_pairs(filenames, src, dst)
             else: # query image
-                new_group_found = False
-                hsh = np.array([self.hashcache.gen_hash(args.query)]).astype('float32')
-                self.group[current_group_num] = []
-                distances, labels = faiss_flat_index.search(hsh, args.faiss_flat_k)
-                for label, distance in zip(labels[0], distances[0]):
-                    if distance <= self.hamming_distance:
-                        new_group_found = True
-                        self.group[current_group_num].extend([filenames[label]])
-                if new_group_found:
+                hsh = np.packbits(self.gen_query_hash(args.query))
+                with self.stats.stage('search'):
+                    labels, _distances = ooc_index.range_search(hsh)
+                if len(labels) > 0:
+                    self.group[current_group_num] = [filenames[label] for label in labels]
                     current_group_num += 1
+            self.stats.count('search_calls')
+            self.stats.count('candidate_pairs', ooc_index.num_candidates)
+            ooc_index.close()
+
 
+        if self.only_new:
+            current_group_num = self.keep_new_groups()
 
         # sort self.group
         if self.sort != 'none':
-            self.sort_group()
+            with self.stats.stage('sort'):
+                self.sort_group()
 
         # write duplicate log file
         self.num_duplicate_set = current_group_num - 1
@@ -383,6 +456,51 @@ class ImageDeduper:
                                 f.write("\n")
 
 
+    def batch_search(self, search, rows, batch_size):
+        # search(rows) returns (labels, distances) of k nearest neighbors of the query rows
+        # (label -1 for missing results). Return (src, dst, distance) of the neighbors
+        # within hamming_distance.
+        results = []
+        with tqdm(total=len(rows)) as pbar, self.stats.stage('search'):
+            for start, end in chunk_ranges(len(rows), batch_size):
+                labels, distances = search(rows[start:end])
+                labels = np.asarray(labels, dtype=np.int64)
+                self.stats.count('search_calls')
+                self.stats.count('candidate_pairs', np.count_nonzero(labels >= 0))
+                distances = np.rint(np.minimum(distances, self.hash_bits + 1)).astype(np.int64)
+                src = np.broadcast_to(np.asarray(rows[start:end], dtype=np.int64)[:, None], labels.shape)
+                found = (labels >= 0) & (labels != src) & (distances <= self.hamming_distance)
+                results.append((src[found], labels[found], distances[found]))
+                pbar.update(end - start)
+        return concat_pairs(results)
+
+
+    def group_pairs(self, filenames, src, dst):
+        # group images connected by pairs within hamming_distance, ranking images by
+        # filename so that groups do not depend on the order of the hash cache
+        self.stats.count('pairs', len(src))
+        with self.stats.stage('grouping'):
+            rank = np.empty(len(filenames), dtype=np.int64)
+            rank[sorted(range(len(filenames)), key=filenames.__getitem__)] = np.arange(len(filenames))
+            groups = group_pairs(len(filenames), src, dst, method=self.grouping, rank=rank)
+        for current_group_num, group in enumerate(groups, start=1):
+            self.group[current_group_num] = [filenames[i] for i in group]
+        return len(groups) + 1
+
+
+    def new_rows(self, filenames):
+        # rows of filenames hashed by this run
+        return np.array([row for row, filename in enumerate(filenames) if filename in self.hashcache.added], dtype=np.int64)
+
+
+    def keep_new_groups(self):
+        # keep only the groups with an image hashed by this run, return the next group number
+        groups = [group for _, group in sorted(self.group.items())
+            if any(filename in self.hashcache.added for filename in group)]
+        self.group = {current_group_num: group for current_group_num, group in enumerate(groups, start=1)}
+        return len(groups) + 1
+
+
     def summarize(self, args):
         # summarize dupe information
         if self.num_duplicate_set > 0:
@@ -393,7 +511,8 @@ class ImageDeduper:
             num_duplicate_files = len(duplicate_files)
             numbytes = 0
             for filename in duplicate_files:
-                numbytes += self.duplicate_filesize_dict[filename]
+                filesize, _width, _height = self.get_image_info(filename)
+                numbytes += filesize
             numkilobytes = int(numbytes / 1000)
             print("{} duplicate files (in {} sets), occupying {} KB".format(num_duplicate_files, self.num_duplicate_set, numkilobytes))
         else:
@@ -415,28 +534,40 @@ class ImageDeduper:
         self.group = new_group_dict
 
 
+    def get_image_info(self, img):
+        # (filesize, width, height) recorded while hashing, the file is read only when unknown
+        if self.image_info is None:
+            self.image_info = self.hashcache.image_info()
+        filesize, width, height = self.image_info.get(img, (-1, -1, -1))
+        if filesize < 0:
+            self.stats.count('image_info_stats')
+            filesize = os.path.getsize(img)
+        if width < 0:
+            self.stats.count('image_info_opens')
+            try:
+                with Image.open(img) as current_img:
+                    width, height = current_img.size
+            except:
+                width, height = 0, 0
+        self.image_info[img] = (filesize, width, height)
+        return filesize, width, height
+
+
     def sort_image_list(self, img_list):
         rev = not self.reverse
         img_filesize_dict = {}
         img_size_dict = {}
         img_width_dict = {}
         img_height_dict = {}
+        for img in img_list:
+            filesize, width, height = self.get_image_info(img)
+            img_filesize_dict[img] = filesize
+            img_size_dict[img] = width + height
+            img_width_dict[img] = width
+            img_height_dict[img] = height
         if self.sort == 'none':
+            # the delete prompt shows filesize and dimensions even when not sorted
             return img_list, img_filesize_dict, img_width_dict, img_height_dict
-        for img in img_list:
-            img_filesize_dict[img] = os.path.getsize(img)
-            self.duplicate_filesize_dict[img] = img_filesize_dict[img]
-            try:
-                with Image.open(img) as current_img:
-                    width, height = current_img.size
-                    img_size_dict[img] = width + height
-                    img_width_dict[img] = width
-                    img_height_dict[img] = height
-            except:
-                width, height = 0, 0
-                img_size_dict[img] = 0
-                img_width_dict[img] = 0
-                img_height_dict[img] = 0
         if self.sort:
             if self.sort == 'filesize':
                 sorted_filesize_dict = sorted(img_filesize_dict.items(), key=itemgetter(1), reverse=rev)
@@ -460,41 +591,67 @@ class ImageDeduper:
         return sorted_img_list, img_filesize_dict, img_width_dict, img_height_dict
 
 
+    def get_thumbnail_cache(self):
+        # thumbnails are keyed by absolute path, so a single cache serves every target directory
+        if not self.cache:
+            return None
+        return ThumbnailCache(os.path.join(self.cache_dir, 'thumbnails') if self.cache_dir else 'thumbnail_cache')
+
+
+    def tile_prefetcher(self, filename_lists, args):
+        # dimensions recorded while hashing choose the reduced decode scale of each image
+        image_dims = {}
+        for filenames in filename_lists:
+            for filename in filenames:
+                _filesize, width, height = self.get_image_info(filename)
+                image_dims[filename] = (width, height)
+        return TilePrefetcher(filename_lists, args, self.get_thumbnail_cache(), image_dims)
+
+
     def print_duplicates(self, args):
         if args.query:
             if args.imgcat:
-                imgcat_for_iTerm2(create_tile_img([args.query], args))
+                imgcat_for_iTerm2(create_tile_img([args.query], args, self.get_thumbnail_cache()))
             print("Query: {}\n".format(args.query))
 
-        for k in range(1, self.num_duplicate_set + 1):
-            img_list = self.group[k]
-            pad = 1 if args.query else 0
-            if len(img_list) + pad > 1:
-                sorted_img_list, _, _, _ = self.sort_image_list(img_list)
-                if args.imgcat:
-                    imgcat_for_iTerm2(create_tile_img(sorted_img_list, args))
+        pad = 1 if args.query else 0
+        sorted_lists = [self.sort_image_list(self.group[k])[0] for k in range(1, self.num_duplicate_set + 1)
+            if len(self.group[k]) + pad > 1]
+        prefetcher = self.tile_prefetcher(sorted_lists, args) if args.imgcat else None
+        try:
+            for current_set, sorted_img_list in enumerate(sorted_lists):
+                if prefetcher is not None:
+                    with self.stats.stage('render'):
+                        imgcat_for_iTerm2(prefetcher.get(current_set))
                 if args.sameline:
                     print(" ".join(sorted_img_list))
                 else:
                     print("\n".join(sorted_img_list) + "\n")
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
 
 
     def preserve(self, args):
         deleted_filenames = []
-        current_set = 0
 
         if args.query:
             if args.imgcat:
-                imgcat_for_iTerm2(create_tile_img([args.query], args))
+                imgcat_for_iTerm2(create_tile_img([args.query], args, self.get_thumbnail_cache()))
             print("Query: {}\n".format(args.query))
 
-        for _k, img_list in self.group.items():
-            pad = 1 if args.query else 0
-            if len(img_list) + pad > 1:
-                current_set += 1
-                sorted_img_list, img_filesize_dict, img_width_dict, img_height_dict = self.sort_image_list(img_list)
-                if args.imgcat:
-                    imgcat_for_iTerm2(create_tile_img(sorted_img_list, args))
+        pad = 1 if args.query else 0
+        sorted_sets = [(img_list,) + self.sort_image_list(img_list) for _k, img_list in self.group.items() if len(img_list) + pad > 1]
+        prefetcher = self.tile_prefetcher([sorted_set[1] for sorted_set in sorted_sets], args) if args.imgcat else None
+        deleter = None
+        if args.run:
+            deleter = DeleteExecutor(args.delete_action, args.delete_journal or self.get_delete_journal_name(),
+                num_threads=args.delete_threads, quarantine_dir=args.quarantine_dir)
+        try:
+            for current_set, (img_list, sorted_img_list, img_filesize_dict, img_width_dict, img_height_dict) in enumerate(sorted_sets, start=1):
+                if prefetcher is not None:
+                    with self.stats.stage('render'):
+                        imgcat_for_iTerm2(prefetcher.get(current_set - 1))
 
                 # check different parent dir
                 parent_set = IndexedSet([])
@@ -517,21 +674,37 @@ class ImageDeduper:
                 if args.noprompt:
                     delete_list = [i for i in range(2, len(sorted_img_list)+1)]
                 else:
-                    delete_list = self.preserve_file_question(len(sorted_img_list))
+                    with self.stats.stage('prompt'):
+                        delete_list = self.preserve_file_question(len(sorted_img_list))
                 logger.debug("delete_list: {}".format(delete_list))
+                # hardlink and reflink replace deleted files with the first preserved file
+                keep_files = [img for i, img in enumerate(sorted_img_list, start=1) if i not in delete_list]
+                keep_file = keep_files[0] if len(keep_files) > 0 else None
 
                 print("")
                 for i in range(1, len(img_list)+1):
                     if i in delete_list:
                         delete_file = sorted_img_list[i-1]
                         print("   [-] {}".format(delete_file))
-                        if args.run:
-                            self.delete_image(delete_file)
+                        if deleter is not None:
+                            with self.stats.stage('delete'):
+                                deleter.submit(delete_file, keep_file)
                         deleted_filenames.append(delete_file)
                     else:
                         preserve_file = sorted_img_list[i-1]
                         print("   [+] {}".format(preserve_file))
                 print("")
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            if deleter is not None:
+                # wait for the actions still running, the journal records each of them
+                with self.stats.stage('delete'):
+                    deleter.close()
+                for status, count in deleter.counts.items():
+                    self.stats.count('delete_' + status, count)
+                if len(deleter.counts) > 0:
+                    logger.warning("Journal of {} actions: {}".format(args.delete_action, deleter.journal.path))
 
         # write delete log file
         if len(deleted_filenames) >0 and  args.run and args.log:
@@ -544,11 +717,3 @@ class ImageDeduper:
         if not args.run:
             logger.debug("dry-run")
             logger.debug("delete_candidate: {}".format(deleted_filenames))
-
-
-    def delete_image(self, delete_file):
-        try:
-            os.remove(delete_file)
-        except FileNotFoundError as e:
-            logger.error(e)
-            pass
@@ -7,8 +7,11 @@ logger.addHandler(handler)
 logger.propagate = False
 
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import cv2
+import hashlib
 import os
 import math
 import sys
@@ -17,6 +20,12 @@ import numpy as np
 
 stdout = getattr(sys.stdout, 'buffer', sys.stdout)
 
+# number of upcoming tiles rendered while the current one is shown
+PREFETCH_TILES = 3
+
+# decode scales of cv2.imread, largest first
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
 
 def create_blank(height, width, rgb_color):
     blank_img = np.zeros((height, width, 3), np.uint8)
@@ -61,7 +70,58 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
-def create_tile_img(filename_list, args):
+def read_reduced(filename, dims, resize_x, resize_y, keep_aspect):
+    # Decode at the smallest scale (1/2, 1/4 or 1/8) which is still not smaller than the
+    # tile, JPEG images are decoded at that scale. dims is (width, height) or None.
+    if dims is not None and min(dims) > 0:
+        width, height = dims
+        if keep_aspect:
+            max_scale = 1 / min(resize_x / width, resize_y / height)
+        else:
+            max_scale = min(width / resize_x, height / resize_y)
+        for scale, flag in REDUCED_FLAGS:
+            if scale <= max_scale:
+                return cv2.imread(filename, flag)
+    return cv2.imread(filename)
+
+
+class ThumbnailCache:
+    """Rendered tile parts stored as PNG files, keyed by path, stat and rendering options."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+
+    def key_path(self, filename, options):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = repr((os.path.abspath(filename), st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev, options))
+        digest = hashlib.blake2b(key.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+        return self.path / digest[:2] / (digest + '.png')
+
+
+    def get(self, filename, options):
+        path = self.key_path(filename, options)
+        if path is None or not path.exists():
+            return None
+        return cv2.imread(str(path))
+
+
+    def put(self, filename, options, image):
+        path = self.key_path(filename, options)
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp{}'.format(os.getpid()))
+        _flag, buf = cv2.imencode('.png', image)
+        tmp_path.write_bytes(buf.tobytes())
+        os.replace(tmp_path, path)
+
+
+def create_tile_img(filename_list, args, thumbnail_cache=None, image_dims=None):
+    # image_dims is {filename: (width, height)} used to choose the decode scale
     if isinstance(args.space_color, str):
         space_color = webcolors.name_to_rgb(args.space_color)
     # interpolation = getattr(cv2, args.interpolation, 1)
@@ -69,9 +129,14 @@ def create_tile_img(filename_list, args):
     tile_num = args.tile_num
     interpolation = getattr(cv2, args.interpolation, 1)
     resize_x, resize_y = int(args.size.split('x')[0]), int(args.size.split('x')[1])
+    options = (args.size, args.keep_aspect, args.interpolation, space, tuple(space_color))
     image_list = []
     for filename in filename_list:
-        img = cv2.imread(filename)
+        part_img = thumbnail_cache.get(filename, options) if thumbnail_cache is not None else None
+        if part_img is not None:
+            image_list.append(part_img)
+            continue
+        img = read_reduced(filename, (image_dims or {}).get(filename), resize_x, resize_y, args.keep_aspect)
         if img is None:
             # create blank image
             part_img = np.zeros((resize_y, resize_x, 3), np.uint8)
@@ -82,6 +147,8 @@ def create_tile_img(filename_list, args):
                 part_img = cv2.resize(img, (resize_x, resize_y), interpolation=interpolation)
             if space > 0:
                 part_img = padding_blank(part_img, space, space, 0, 0, space_color)
+            if thumbnail_cache is not None:
+                thumbnail_cache.put(filename, options, part_img)
 
         image_list.append(part_img)
 
@@ -96,6 +163,44 @@ def create_tile_img(filename_list, args):
     return result_img
 
 
+class TilePrefetcher:
+    """Renders the tiles of upcoming image lists in a background thread.
+
+    get(i) returns the tile of the i-th list and starts rendering the next
+    PREFETCH_TILES lists, so they are ready while the user answers a prompt.
+    """
+
+    def __init__(self, filename_lists, args, thumbnail_cache=None, image_dims=None, depth=PREFETCH_TILES):
+        self.filename_lists = filename_lists
+        self.args = args
+        self.thumbnail_cache = thumbnail_cache
+        self.image_dims = image_dims
+        self.depth = depth
+        # a single thread renders tiles in the order they are requested
+        self.executor = ThreadPoolExecutor(1)
+        self.futures = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def get(self, index):
+        for i in range(index, min(index + self.depth + 1, len(self.filename_lists))):
+            if i not in self.futures:
+                self.futures[i] = self.executor.submit(create_tile_img, self.filename_lists[i], self.args,
+                    self.thumbnail_cache, self.image_dims)
+        return self.futures.pop(index).result()
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 def imgcat_for_iTerm2(imgdata):
     _flag, buf = cv2.imencode('.png', imgdata)
     if os.environ['TERM'].startswith('screen'):
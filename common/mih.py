@@ -0,0 +1,172 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from itertools import combinations
+
+import math
+import numpy as np
+
+from common.hamming import chunk_ranges, concat_pairs, pair_distances, popcount_rows, thread_map
+
+
+# number of (query, substring key) lookups processed at once by each thread
+LOOKUP_BLOCK_SIZE = 1024 * 1024
+
+# number of packed hashes unpacked at once when building substring keys
+UNPACK_BLOCK_SIZE = 1024 * 1024
+
+
+def flip_masks(length, radius):
+    # every bit mask of the given length with at most radius bits set
+    masks = [0]
+    for r in range(1, min(radius, length) + 1):
+        for bits in combinations(range(length), r):
+            mask = 0
+            for b in bits:
+                mask |= 1 << b
+            masks.append(mask)
+    return np.array(masks, dtype=np.uint64)
+
+
+def substring_bounds(hash_bits, num_substrings):
+    # (first bit, last bit + 1) of each of num_substrings disjoint substrings
+    return [(b[0], b[-1] + 1) for b in np.array_split(np.arange(hash_bits), num_substrings)]
+
+
+def substring_keys(packed, hash_bits, bounds):
+    # list of uint64 key arrays of packed hashes, one per substring
+    keys = [np.zeros(len(packed), dtype=np.uint64) for _ in bounds]
+    for start, end in chunk_ranges(len(packed), UNPACK_BLOCK_SIZE):
+        bits = np.unpackbits(packed[start:end], axis=1, count=hash_bits).astype(np.uint64)
+        for t, (b0, b1) in enumerate(bounds):
+            weights = np.left_shift(np.uint64(1), np.arange(b1 - b0, dtype=np.uint64))
+            keys[t][start:end] = (bits[:, b0:b1] * weights).sum(axis=1, dtype=np.uint64)
+    return keys
+
+
+class MultiIndexHashing:
+    """Exact Hamming range search with multi-index hashing.
+
+    Each hash is split into m disjoint substrings and one table is built per substring.
+    If two hashes are within radius r, at least one of their substrings is within
+    r // m of each other, so looking up every substring key within r // m in its table
+    finds every neighbor. Candidates are verified with the full Hamming distance.
+    """
+
+    def __init__(self, packed_hshs, hash_bits, radius, num_substrings=None, num_threads=1, executor=None):
+        self.data = np.ascontiguousarray(packed_hshs, dtype=np.uint8)
+        self.num_elements = len(self.data)
+        self.hash_bits = hash_bits
+        self.radius = radius
+        self.num_threads = max(num_threads, 1)
+        self.executor = executor
+        if num_substrings is None:
+            num_substrings = radius + 1
+        # substring keys are stored as uint64
+        num_substrings = max(num_substrings, int(math.ceil(hash_bits / 64)))
+        self.num_substrings = min(num_substrings, hash_bits)
+        self.substring_radius = radius // self.num_substrings
+        self.bounds = substring_bounds(hash_bits, self.num_substrings)
+        self.masks = [flip_masks(end - start, self.substring_radius) for start, end in self.bounds]
+        self.num_candidates = 0
+
+        self.keys = self.substring_keys(self.data)
+        self.sorted_ids = []
+        self.sorted_keys = []
+        for keys in self.keys:
+            order = np.argsort(keys, kind='stable')
+            self.sorted_ids.append(order)
+            self.sorted_keys.append(keys[order])
+
+
+    def substring_keys(self, packed):
+        return substring_keys(packed, self.hash_bits, self.bounds)
+
+
+    def lookup(self, t, query_keys, query_ids):
+        # return (query id, data id) of every entry of table t within substring_radius
+        masks = self.masks[t]
+        lookup_keys = (query_keys[:, None] ^ masks[None, :]).ravel()
+        lo = np.searchsorted(self.sorted_keys[t], lookup_keys, side='left')
+        hi = np.searchsorted(self.sorted_keys[t], lookup_keys, side='right')
+        counts = hi - lo
+        found = counts > 0
+        lo, counts = lo[found], counts[found]
+        qids = np.repeat(np.repeat(query_ids, len(masks))[found], counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return qids, self.sorted_ids[t][np.repeat(lo, counts) + offsets]
+
+
+    def candidates(self, query_keys, query_ids, upper_only):
+        qids = []
+        ids = []
+        for t in range(self.num_substrings):
+            q, i = self.lookup(t, query_keys[t], query_ids)
+            if upper_only:
+                # each pair is found from both sides, keep it once
+                upper = q < i
+                q, i = q[upper], i[upper]
+            qids.append(q)
+            ids.append(i)
+        key = np.unique(np.concatenate(qids).astype(np.int64) * self.num_elements + np.concatenate(ids))
+        return key // self.num_elements, key % self.num_elements
+
+
+    def all_pairs(self):
+        # return (src, dst, distance) of every pair src < dst within radius
+        radius = self.radius
+        block = max(LOOKUP_BLOCK_SIZE // max(max(len(m) for m in self.masks), 1), 1)
+
+        def search_block(start_end):
+            start, end = start_end
+            query_keys = [keys[start:end] for keys in self.keys]
+            src, dst = self.candidates(query_keys, np.arange(start, end), True)
+            dist = pair_distances(self.data, src, dst)
+            found = dist <= radius
+            return src[found], dst[found], dist[found], len(src)
+
+        results = thread_map(self.executor, self.num_threads, search_block, chunk_ranges(self.num_elements, block))
+        self.num_candidates += sum(r[3] for r in results)
+        return concat_pairs([r[:3] for r in results])
+
+
+    def query_pairs(self, rows):
+        # return (src, dst, distance) of every hash within radius from the hashes at rows,
+        # each pair once (src is in rows)
+        radius = self.radius
+        rows = np.asarray(rows, dtype=np.int64)
+        is_query = np.zeros(self.num_elements, dtype=bool)
+        is_query[rows] = True
+        block = max(LOOKUP_BLOCK_SIZE // max(max(len(m) for m in self.masks), 1), 1)
+
+        def search_block(start_end):
+            start, end = start_end
+            query_ids = rows[start:end]
+            query_keys = [keys[query_ids] for keys in self.keys]
+            src, dst = self.candidates(query_keys, query_ids, False)
+            keep = (src < dst) | ~is_query[dst]
+            src, dst = src[keep], dst[keep]
+            dist = pair_distances(self.data, src, dst)
+            found = dist <= radius
+            return src[found], dst[found], dist[found], len(src)
+
+        results = thread_map(self.executor, self.num_threads, search_block, chunk_ranges(len(rows), block))
+        self.num_candidates += sum(r[3] for r in results)
+        return concat_pairs([r[:3] for r in results])
+
+
+    def range_search(self, packed_query):
+        # return (labels, distances) of every hash within radius from a single packed query
+        query_keys = self.substring_keys(packed_query.reshape(1, -1))
+        _, labels = self.candidates(query_keys, np.zeros(1, dtype=np.int64), False)
+        self.num_candidates += len(labels)
+        distances = popcount_rows(self.data[labels] ^ packed_query)
+        found = distances <= self.radius
+        labels, distances = labels[found], distances[found]
+        order = np.lexsort((labels, distances))
+        return labels[order], distances[order]
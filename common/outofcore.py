@@ -0,0 +1,266 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from pathlib import Path
+
+import math
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+from common.hamming import PREFILTER_MIN_SUBSTRING_BITS, chunk_ranges, concat_pairs, hamming_distances, popcount_rows, thread_map
+from common.mih import substring_bounds, substring_keys
+
+
+# maximum number of bucket files written for each substring
+MAX_BUCKETS = 4096
+
+PAIR_DTYPES = {'src': np.int64, 'dst': np.int64, 'dist': np.uint32}
+
+
+class PairSpill:
+    """(src, dst, distance) pairs appended to files instead of kept in memory."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.num_pairs = 0
+
+
+    def append(self, src, dst, dist):
+        with self.lock:
+            for name, values in zip(PAIR_DTYPES, (src, dst, dist)):
+                with open(self.path / (name + '.bin'), 'ab') as f:
+                    np.asarray(values, dtype=PAIR_DTYPES[name]).tofile(f)
+            self.num_pairs += len(src)
+
+
+    def load(self):
+        # return (src, dst, distance) memory-mapped from the pair files
+        if self.num_pairs == 0:
+            return concat_pairs([])
+        return tuple(np.memmap(self.path / (name + '.bin'), dtype=dtype, mode='r', shape=(self.num_pairs,))
+            for name, dtype in PAIR_DTYPES.items())
+
+
+class OutOfCoreIndex:
+    """Exact Hamming range search over packed hashes which do not fit in memory.
+
+    The hashes are read in chunks from an array which is usually a numpy.memmap of the
+    hash cache, and no step holds more than about max_memory bytes. When hashes are long
+    enough for the pigeonhole principle (radius + 1 substrings of at least 16 bits), each
+    substring is bucketed on disk by its key, and only hashes with the same key in a
+    bucket are compared. A pair found by several substrings is kept by the first one.
+    Shorter hashes are compared block by block. Pairs are written to work_dir.
+    """
+
+    def __init__(self, packed_hshs, hash_bits, radius, max_memory, valid=None, work_dir=None,
+            num_threads=1, executor=None):
+        self.data = packed_hshs
+        self.num_elements, self.hash_bytes = self.data.shape
+        self.hash_bits = hash_bits
+        self.radius = radius
+        self.num_threads = max(num_threads, 1)
+        self.executor = executor
+        # rows of failed images are never searched
+        self.valid = np.ones(self.num_elements, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        self.thread_memory = max(max_memory // self.num_threads, 1)
+        self.work_dir = Path(tempfile.mkdtemp(prefix='imgdupes_', dir=work_dir))
+        self.record_dtype = np.dtype([('row', np.int64), ('hash', np.uint8, (self.hash_bytes,))])
+        self.block_size = max(math.isqrt(self.thread_memory // (self.hash_bytes + 8)), 1)
+        # chunk of hashes read at once, including the unpacked bits of substring keys
+        self.chunk_size = max(self.thread_memory // (hash_bits * 8 + 2 * self.record_dtype.itemsize + 16), 1)
+        num_substrings = max(radius + 1, int(math.ceil(hash_bits / 64)))
+        if hash_bits // num_substrings >= PREFILTER_MIN_SUBSTRING_BITS:
+            self.bounds = substring_bounds(hash_bits, num_substrings)
+        else:
+            self.bounds = None
+        self.num_candidates = 0
+
+
+    def all_pairs(self):
+        # return (src, dst, distance) of every pair src < dst within radius
+        return self.search_pairs(None)
+
+
+    def query_pairs(self, rows):
+        # return (src, dst, distance) of every hash within radius from the hashes at rows,
+        # each pair once (src is in rows)
+        is_query = np.zeros(self.num_elements, dtype=bool)
+        is_query[np.asarray(rows, dtype=np.int64)] = True
+        return self.search_pairs(is_query & self.valid)
+
+
+    def search_pairs(self, is_query):
+        spill = PairSpill(tempfile.mkdtemp(prefix='pairs_', dir=self.work_dir))
+        if self.bounds is None:
+            logger.debug("out-of-core block search (block size={})".format(self.block_size))
+            self.block_pairs(spill, is_query)
+        else:
+            for t in range(len(self.bounds)):
+                self.substring_pairs(t, spill, is_query)
+        logger.debug("out-of-core candidates: {}, pairs: {}".format(self.num_candidates, spill.num_pairs))
+        return spill.load()
+
+
+    def range_search(self, packed_query, radius=None):
+        # return (labels, distances) of every hash within radius from a single packed query
+        radius = self.radius if radius is None else radius
+        labels = []
+        distances = []
+        for start, end in chunk_ranges(self.num_elements, self.chunk_size):
+            dist = popcount_rows(np.asarray(self.data[start:end]) ^ packed_query)
+            found = np.nonzero((dist <= radius) & self.valid[start:end])[0]
+            labels.append(found + start)
+            distances.append(dist[found])
+        labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+        distances = np.concatenate(distances) if distances else np.zeros(0, dtype=np.uint32)
+        order = np.lexsort((labels, distances))
+        return labels[order], distances[order]
+
+
+    def block_pairs(self, spill, is_query):
+        # compare blocks of hashes with every later block (every block for queries)
+        block = self.block_size
+        radius = self.radius
+        if is_query is None:
+            starts = list(chunk_ranges(self.num_elements, block))
+        else:
+            query_rows = np.nonzero(is_query)[0]
+            starts = list(chunk_ranges(len(query_rows), block))
+
+        def search_block(start_end):
+            start, end = start_end
+            if is_query is None:
+                src_rows = np.arange(start, end)
+            else:
+                src_rows = query_rows[start:end]
+            src_hashes = np.asarray(self.data[start:end] if is_query is None else self.data[src_rows])
+            num_candidates = 0
+            for other_start, other_end in chunk_ranges(self.num_elements, block):
+                if is_query is None and other_end <= start:
+                    continue
+                dist = hamming_distances(src_hashes, np.asarray(self.data[other_start:other_end]))
+                num_candidates += dist.size
+                s, d = np.nonzero(dist <= radius)
+                dist = dist[s, d]
+                s, d = src_rows[s], d + other_start
+                keep = self.valid[s] & self.valid[d]
+                if is_query is None:
+                    keep &= s < d
+                else:
+                    keep &= (s < d) | ~is_query[d]
+                if keep.any():
+                    spill.append(s[keep], d[keep], dist[keep])
+            return num_candidates
+
+        self.num_candidates += sum(thread_map(self.executor, self.num_threads, search_block, starts))
+
+
+    def num_buckets(self):
+        # buckets of a substring small enough to be sorted and searched within memory
+        record_memory = 3 * self.record_dtype.itemsize + 40
+        needed = int(self.valid.sum()) * record_memory / self.thread_memory
+        num_buckets = 1
+        while num_buckets < needed and num_buckets < MAX_BUCKETS:
+            num_buckets *= 2
+        return num_buckets
+
+
+    def write_buckets(self, t, num_buckets):
+        # write the valid rows and hashes to bucket files by the key of substring t
+        bucket_dir = self.work_dir / 'buckets'
+        bucket_dir.mkdir(exist_ok=True)
+        mask = np.uint64(num_buckets - 1)
+        for start, end in chunk_ranges(self.num_elements, self.chunk_size):
+            rows = np.nonzero(self.valid[start:end])[0] + start
+            records = np.empty(len(rows), dtype=self.record_dtype)
+            records['row'] = rows
+            records['hash'] = self.data[start:end][rows - start]
+            buckets = substring_keys(records['hash'], self.hash_bits, self.bounds[t:t + 1])[0] & mask
+            order = np.argsort(buckets, kind='stable')
+            records, buckets = records[order], buckets[order]
+            bounds = np.searchsorted(buckets, np.arange(num_buckets + 1, dtype=np.uint64))
+            for bucket in np.nonzero(np.diff(bounds))[0]:
+                with open(bucket_dir / "{}.bin".format(bucket), 'ab') as f:
+                    records[bounds[bucket]:bounds[bucket + 1]].tofile(f)
+        return [bucket_dir / "{}.bin".format(bucket) for bucket in range(num_buckets)]
+
+
+    def substring_pairs(self, t, spill, is_query):
+        # find the pairs whose first identical substring is t
+        num_buckets = self.num_buckets()
+        logger.debug("out-of-core substring {}/{} (buckets={})".format(t + 1, len(self.bounds), num_buckets))
+        bucket_paths = self.write_buckets(t, num_buckets)
+
+        def search_bucket(path):
+            if not path.exists():
+                return 0
+            records = np.fromfile(path, dtype=self.record_dtype)
+            path.unlink()
+            hashes = np.ascontiguousarray(records['hash'])
+            keys = substring_keys(hashes, self.hash_bits, self.bounds[t:t + 1])[0]
+            order = np.argsort(keys, kind='stable')
+            keys, rows, hashes = keys[order], records['row'][order], hashes[order]
+            del records
+            # end of the run of the same key at each position
+            run_starts = np.concatenate([[0], np.nonzero(np.diff(keys))[0] + 1])
+            run_ends = np.append(run_starts[1:], len(keys))
+            run_end = np.repeat(run_ends, run_ends - run_starts)
+            positions = np.arange(len(keys))
+            if is_query is not None:
+                # only runs including a query
+                run_has_query = np.maximum.reduceat(is_query[rows], run_starts) if len(keys) > 0 else []
+                positions = positions[np.repeat(run_has_query, run_ends - run_starts)]
+            # compare each position with the position offset later in the same run
+            offset = 1
+            active = positions[positions + offset < run_end[positions]]
+            num_candidates = 0
+            while len(active) > 0:
+                a, b = rows[active], rows[active + offset]
+                if is_query is not None:
+                    with_query = is_query[a] | is_query[b]
+                    a, b, pair_active = a[with_query], b[with_query], active[with_query]
+                else:
+                    pair_active = active
+                num_candidates += len(a)
+                xor = hashes[pair_active] ^ hashes[pair_active + offset]
+                dist = popcount_rows(xor)
+                found = dist <= self.radius
+                found[found] = self.first_identical(xor[found]) == t
+                if found.any():
+                    a, b, dist = a[found], b[found], dist[found]
+                    if is_query is None:
+                        spill.append(np.minimum(a, b), np.maximum(a, b), dist)
+                    else:
+                        # src is a query, the smaller one when both are queries
+                        swap = ~is_query[a] | (is_query[b] & (b < a))
+                        spill.append(np.where(swap, b, a), np.where(swap, a, b), dist)
+                offset += 1
+                active = active[active + offset < run_end[active]]
+            return num_candidates
+
+        try:
+            self.num_candidates += sum(thread_map(self.executor, self.num_threads, search_bucket, bucket_paths))
+        finally:
+            for path in bucket_paths:
+                if path.exists():
+                    path.unlink()
+
+
+    def first_identical(self, xor):
+        # index of the first substring where the XORed hashes are all zero
+        bits = np.unpackbits(xor, axis=1, count=self.hash_bits)
+        identical = np.stack([~bits[:, b0:b1].any(axis=1) for b0, b1 in self.bounds], axis=1)
+        return np.argmax(identical, axis=1)
+
+
+    def close(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
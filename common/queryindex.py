@@ -0,0 +1,94 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+import threading
+import numpy as np
+
+from common.hamming import PopcountIndex, popcount_rows
+from common.mih import MultiIndexHashing
+from common.annindex import AnnIndex
+from common.outofcore import OutOfCoreIndex
+
+
+class QueryIndex:
+    """Index of the hashes of a HashCache answering Hamming range queries.
+
+    The index of the chosen engine is built once and searched by batches of packed query
+    hashes. NGT, hnsw and faiss indexes saved at index_path are updated instead of built.
+    Candidates of approximate engines are verified with the exact Hamming distance, so
+    every engine reports the same distances.
+    """
+
+    def __init__(self, hashcache, args, workers, index_path=None, cuda_device=None):
+        self.filenames = hashcache.filenames()
+        self.data = np.ascontiguousarray(hashcache.packed_hshs(), dtype=np.uint8)
+        self.hash_bits = hashcache.hash_bits
+        self.hash_bytes = hashcache.hash_bytes
+        self.hamming_distance = args.hamming_distance
+        self.engine = args.engine
+        self.args = args
+        self.num_proc = workers.num_proc
+        # searches of NGT, hnsw and faiss indexes are not run concurrently
+        self.lock = threading.Lock()
+        logger.warning("Building {} index of {} images (bits={}, num_proc={})".format(
+            self.engine, len(self.filenames), self.hash_bits, self.num_proc))
+        if self.engine in ('ngt', 'hnsw', 'faiss-flat'):
+            self.index = AnnIndex(self.engine, self.hash_bits, args, self.num_proc, path=index_path,
+                executor=workers.threads(), cuda_device=cuda_device if args.faiss_cuda else None)
+            new_rows = self.index.sync(self.filenames, self.data)
+            # pairs of the last run are kept while no image is left unsearched
+            self.index.save(self.filenames, self.data, self.index.known_pairs() if len(new_rows) == 0 else None)
+        elif self.engine == 'popcount':
+            self.index = PopcountIndex(self.data, self.hash_bits, num_threads=self.num_proc, executor=workers.threads())
+        elif self.engine == 'mih':
+            self.index = MultiIndexHashing(self.data, self.hash_bits, self.hamming_distance,
+                num_substrings=args.mih_substrings, num_threads=self.num_proc, executor=workers.threads())
+        elif self.engine == 'outofcore':
+            self.index = OutOfCoreIndex(self.data, self.hash_bits, self.hamming_distance, args.max_memory,
+                num_threads=self.num_proc, executor=workers.threads())
+        else:
+            raise ValueError("Unknown search engine: {}".format(self.engine))
+
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+    def search(self, packed_queries):
+        # return [(filename, distance), ...] within hamming_distance, nearest first, for each
+        # row of packed_queries
+        packed_queries = np.ascontiguousarray(packed_queries, dtype=np.uint8).reshape(-1, self.hash_bytes)
+        if len(packed_queries) == 0 or len(self.data) == 0:
+            return [[] for _ in packed_queries]
+        with self.lock:
+            candidates = self.candidates(packed_queries)
+        results = []
+        for query, labels in zip(packed_queries, candidates):
+            labels = np.unique(np.asarray(labels, dtype=np.int64))
+            labels = labels[labels >= 0]
+            distances = popcount_rows(self.data[labels] ^ query)
+            found = distances <= self.hamming_distance
+            labels, distances = labels[found], distances[found]
+            order = np.lexsort((labels, distances))
+            results.append([(self.filenames[label], int(distance)) for label, distance in zip(labels[order], distances[order])])
+        return results
+
+
+    def candidates(self, packed_queries):
+        # labels of candidate neighbors of each query
+        if self.engine in ('ngt', 'hnsw', 'faiss-flat'):
+            labels, _distances = self.index.search(packed_queries)
+            return labels
+        elif self.engine == 'popcount':
+            return [self.index.range_search(query, self.hamming_distance)[0] for query in packed_queries]
+        return [self.index.range_search(query)[0] for query in packed_queries]
+
+
+    def close(self):
+        if isinstance(self.index, (AnnIndex, OutOfCoreIndex)):
+            self.index.close()
@@ -0,0 +1,153 @@
+from logging import getLogger, StreamHandler, DEBUG
+logger = getLogger(__name__)
+handler = StreamHandler()
+# handler.setLevel(DEBUG)
+# logger.setLevel(DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import json
+import socketserver
+import numpy as np
+
+
+# largest request body accepted by the server
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+
+def hash_to_hex(packed, hash_bits):
+    # hex string of a packed hash, same as str() of imagehash.ImageHash
+    bits = np.unpackbits(packed, count=hash_bits)
+    value = int(''.join(str(bit) for bit in bits), 2)
+    return format(value, '0{}x'.format(-(-hash_bits // 4)))
+
+
+def hex_to_hash(hex_str, hash_bits):
+    # packed hash of a hex string of imagehash.ImageHash
+    value = int(hex_str, 16)
+    if value >> hash_bits:
+        raise ValueError("hash is longer than {} bits: {}".format(hash_bits, hex_str))
+    bits = [(value >> (hash_bits - 1 - i)) & 1 for i in range(hash_bits)]
+    return np.packbits(np.array(bits, dtype=np.uint8))
+
+
+class QueryService:
+    """Answers near-duplicate queries against a resident QueryIndex.
+
+    A request is a JSON object with a list of image paths and/or a list of hex hashes
+    (as printed by imagehash). Paths are hashed by the shared hashing processes, and all
+    queries of a request are searched as one batch.
+    """
+
+    def __init__(self, hashcache, index):
+        self.hashcache = hashcache
+        self.index = index
+        if hashcache.workers is not None:
+            # start the hashing processes before request threads share them
+            hashcache.workers.hash_pool(hashcache.hasher())
+
+
+    def info(self):
+        return {
+            'images': len(self.index),
+            'engine': self.index.engine,
+            'hash_method': self.hashcache.hash_method,
+            'hash_bits': self.hashcache.hash_bits,
+            'hamming_distance': self.index.hamming_distance,
+        }
+
+
+    def query(self, request):
+        paths = request.get('paths', [])
+        hashes = request.get('hashes', [])
+        if not isinstance(paths, list) or not isinstance(hashes, list):
+            raise ValueError("'paths' and 'hashes' must be lists")
+        results = [{'path': path} for path in paths] + [{'hash': hsh} for hsh in hashes]
+        packed = self.hashcache.hash_files(paths) if len(paths) > 0 else []
+        for hsh in hashes:
+            try:
+                packed.append(hex_to_hash(hsh, self.hashcache.hash_bits))
+            except (TypeError, ValueError):
+                packed.append(None)
+
+        queries = [row for row, hsh in enumerate(packed) if hsh is not None]
+        if len(queries) > 0:
+            matches = self.index.search(np.array([packed[row] for row in queries]))
+        else:
+            matches = []
+        for row, found in zip(queries, matches):
+            results[row]['hash'] = hash_to_hex(packed[row], self.hashcache.hash_bits)
+            results[row]['matches'] = [{'filename': filename, 'distance': distance} for filename, distance in found]
+        for row, hsh in enumerate(packed):
+            if hsh is None:
+                if 'path' in results[row]:
+                    results[row]['error'] = "Unable to calculate image hash"
+                else:
+                    results[row]['error'] = "Invalid hash"
+        return {'results': results}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET /health returns the index information, POST /query answers a batch of queries."""
+
+    server_version = "imgdupes"
+
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.server.service.info())
+        else:
+            self.send_json(404, {'error': "Not found: {}".format(self.path)})
+
+
+    def do_POST(self):
+        if self.path != '/query':
+            self.send_json(404, {'error': "Not found: {}".format(self.path)})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_REQUEST_BYTES:
+            self.send_json(413, {'error': "Request is larger than {} bytes".format(MAX_REQUEST_BYTES)})
+            return
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            response = self.server.service.query(request)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, response)
+
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def address_string(self):
+        # clients of UNIX sockets have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host, port, socket_path=None):
+    # HTTP server on a UNIX socket when socket_path is given, otherwise on TCP host:port
+    if socket_path:
+        server = ThreadingUnixHTTPServer(socket_path, QueryHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.service = service
+    return server
@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from pathlib import Path
+
+import cProfile
+import json
+import resource
+import sys
+import threading
+import time
+
+
+class RunStats:
+    """Wall and CPU time of the stages of a run, counters and resource usage.
+
+    A stage is timed by `with stats.stage(name):` and may be entered many times and
+    nested, the time of a stage includes its nested stages. CPU time is that of this
+    process (all threads); hashing processes are reported as a whole under resources.
+    When profile_dir is given, every outermost stage is profiled with cProfile into
+    profile_dir/<stage>.prof.
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.depth = 0
+
+
+    def record(self, name, wall, cpu, items=0):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0})
+            stage['calls'] += 1
+            stage['wall_seconds'] += wall
+            stage['cpu_seconds'] += cpu
+            stage['items'] += items
+
+
+    @contextmanager
+    def stage(self, name):
+        profile = None
+        if self.profile_dir is not None and self.depth == 0:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        self.depth += 1
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall, time.process_time() - cpu)
+            self.depth -= 1
+            if profile is not None:
+                profile.disable()
+
+
+    def timed_iter(self, name, iterable):
+        # time spent producing the items of iterable (e.g. a directory scanner), which is
+        # interleaved with the stages consuming them
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(name, time.perf_counter() - wall, time.process_time() - cpu)
+                return
+            self.record(name, time.perf_counter() - wall, time.process_time() - cpu, items=1)
+            yield item
+
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+
+    def items(self, name, n):
+        # number of items (e.g. files) processed by a stage, for items_per_second
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'items': 0})
+            stage['items'] += int(n)
+
+
+    def report(self):
+        stages = {}
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            if stage['calls'] > 0 and stage['wall_seconds'] > 0 and stage['items'] > 0:
+                stage['items_per_second'] = stage['items'] / stage['wall_seconds']
+            stages[name] = stage
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        return {
+            'command': sys.argv,
+            'start_time': self.start_time,
+            'wall_seconds': time.perf_counter() - self.start_wall,
+            'cpu_seconds': time.process_time() - self.start_cpu,
+            'stages': stages,
+            'counters': dict(self.counters),
+            'resources': {
+                'peak_rss_bytes': usage.ru_maxrss * rss_unit,
+                'children_peak_rss_bytes': children.ru_maxrss * rss_unit,
+                'children_cpu_seconds': children.ru_utime + children.ru_stime,
+                'read_blocks': usage.ru_inblock + children.ru_inblock,
+            },
+        }
+
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+    def dump_profiles(self):
+        if self.profile_dir is None:
+            return
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(str(self.profile_dir / "{}.prof".format(name)))
@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import os
+
+
+IMAGE_SUFFIXES = frozenset(['.png', '.jpg', '.jpeg', '.gif'])
+
+# number of threads listing directories at the same time
+SCAN_THREADS = 8
+
+
+def is_image_name(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_SUFFIXES
+
+
+def dir_key(path):
+    # (device, inode) of a directory, following symlinks
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+
+def list_dir(path):
+    # return (image filenames, [(subdirectory, dir_key)]) of a directory, symlinks to
+    # directories included
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # same form as str(Path(path) / name), without the leading './'
+                entry_path = entry.name if path == '.' else entry.path
+                try:
+                    if entry.is_dir():
+                        dirs.append((entry_path, dir_key(entry.path)))
+                    elif is_image_name(entry.name) and entry.is_file():
+                        files.append(entry_path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files, dirs
+
+
+def scan_images(target_dir, recursive=False, num_threads=SCAN_THREADS):
+    # Yield image filenames as soon as their directory is listed. Directories are listed
+    # in parallel threads, so the order of filenames is not defined. Symlinks to
+    # directories are followed like Path.glob('**'), and a directory reached again
+    # (a symlink loop or another link to it) is listed only once.
+    target_dir = str(Path(target_dir))
+    try:
+        visited = {dir_key(target_dir)}
+    except OSError:
+        visited = set()
+    with ThreadPoolExecutor(num_threads) as executor:
+        pending = {executor.submit(list_dir, target_dir)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                if recursive:
+                    for d, key in dirs:
+                        if key not in visited:
+                            visited.add(key)
+                            pending.add(executor.submit(list_dir, d))
+                yield from files
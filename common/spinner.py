@@ -28,7 +28,8 @@ class Spinner:
 
     def start(self):
         self.busy = True
-        threading.Thread(target=self.spinner_task).start()
+        # a daemon thread never keeps the process alive when an error stops the caller
+        threading.Thread(target=self.spinner_task, daemon=True).start()
 
     def stop(self):
         self.busy = False
@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count, Pool
+
+import threading
+
+
+# hasher of the current hashing process, set once by init_hasher
+_hasher = None
+
+
+def default_num_proc():
+    return max(cpu_count() - 1, 1)
+
+
+def init_hasher(hasher):
+    global _hasher
+    _hasher = hasher
+
+
+def hash_chunk(tasks):
+    # return (filename, wanted, hashes, (width, height)) for each (filename, wanted) task
+    return [task + result for task, result in zip(tasks, _hasher.gen_hashes(tasks))]
+
+
+class Workers:
+    """Process pool for hashing and thread pool for searching, shared by all stages.
+
+    Both pools are created at first use, also from several threads. The hasher is sent
+    to each hashing process once when the pool starts, so a task only carries filenames. Use it as a context
+    manager: the pools are closed and joined on exit, or terminated on errors.
+    """
+
+    def __init__(self, num_proc=None):
+        self.num_proc = default_num_proc() if num_proc is None else max(num_proc, 1)
+        self.hasher = None
+        self.pool = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+    def hash_pool(self, hasher):
+        with self.lock:
+            if self.pool is None:
+                self.hasher = hasher
+                self.pool = Pool(self.num_proc, initializer=init_hasher, initargs=(hasher,))
+            elif hasher is not self.hasher:
+                raise ValueError("Hashing processes are already started with another hasher")
+            return self.pool
+
+
+    def hash_async(self, hasher, tasks):
+        return self.hash_pool(hasher).apply_async(hash_chunk, (tasks,))
+
+
+    def threads(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.num_proc)
+            return self.executor
+
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# common/ is imported from the repository root, as by the imgdupes script
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
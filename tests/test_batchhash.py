@@ -0,0 +1,60 @@
+import numpy
+import pytest
+from PIL import Image, ImageFilter
+
+from common.batchhash import BATCH_METHODS, batch_hash, resize_gray
+from common.hashcache import HashCache
+
+
+HASH_SIZES = [2, 3, 7, 8, 12, 16]
+
+
+def sample_images():
+    # noise, smooth and flat images of several sizes and modes
+    rng = numpy.random.default_rng(0)
+    images = []
+    for width, height in [(64, 48), (333, 517), (1024, 768), (17, 9)]:
+        noise = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=numpy.uint8), 'RGB')
+        images.append(noise)
+        images.append(noise.filter(ImageFilter.GaussianBlur(4)))
+    images.append(Image.new('L', (100, 80), 128))
+    images.append(Image.fromarray(rng.integers(0, 256, (50, 70, 4), dtype=numpy.uint8), 'RGBA'))
+    return [image.convert("L") for image in images]
+
+
+@pytest.mark.parametrize('hash_size', HASH_SIZES)
+@pytest.mark.parametrize('hash_method', BATCH_METHODS)
+def test_batch_hash_equals_reference(hash_method, hash_size):
+    grays = sample_images()
+    hashcache = HashCache(None, [], hash_method, hash_size, 1)
+    packed = batch_hash(hash_method, numpy.stack([resize_gray(gray, hash_method, hash_size) for gray in grays]), hash_size)
+    assert packed.shape == (len(grays), hashcache.hash_bytes)
+    for gray, hsh in zip(grays, packed):
+        assert numpy.array_equal(hashcache.hash_image(gray), hsh)
+
+
+def test_gen_hashes_equals_reference(tmp_path):
+    filenames = []
+    for i, gray in enumerate(sample_images()):
+        filenames.append(str(tmp_path / "{}.png".format(i)))
+        gray.save(filenames[-1])
+    broken = str(tmp_path / 'broken.jpg')
+    with open(broken, 'wb') as f:
+        f.write(b'\xff\xd8 not a jpeg')
+    filenames.insert(3, broken)
+    filenames.append(str(tmp_path / 'missing.jpg'))
+
+    extra_hashes = [(method, size) for method in BATCH_METHODS + ('whash',) for size in (8, 16)]
+    hashcache = HashCache(None, [], 'phash', 8, 1, extra_hashes=extra_hashes)
+    caches = [hashcache] + hashcache.extra_caches
+    results = hashcache.gen_hashes([(filename, (True,) * len(caches)) for filename in filenames])
+    assert len(results) == len(filenames)
+    for filename, (hashes, dims) in zip(filenames, results):
+        if filename in (broken, filenames[-1]):
+            assert hashes == [None] * len(caches) and dims == (0, 0)
+            continue
+        with Image.open(filename) as image:
+            assert dims == image.size
+            gray = image.convert("L")
+        for cache, hsh in zip(caches, hashes):
+            assert numpy.array_equal(cache.hash_image(gray), hsh), (cache.hash_method, cache.hash_size)
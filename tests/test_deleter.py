@@ -0,0 +1,32 @@
+import os
+
+from common.deleter import DeleteExecutor, read_journal, undo_journal
+
+
+def test_quarantine_relative_dir_is_undone_from_another_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / 'a.jpg').write_bytes(b'a')
+    with DeleteExecutor('quarantine', 'journal.jsonl', num_threads=2, quarantine_dir='q') as deleter:
+        deleter.submit(os.path.join('img', 'a.jpg'))
+    entry = read_journal('journal.jsonl')[0]
+    assert entry['status'] == 'done'
+    assert os.path.isabs(entry['path']) and os.path.isabs(entry['target'])
+    assert not (tmp_path / 'img' / 'a.jpg').exists()
+
+    monkeypatch.chdir('/')
+    assert undo_journal(str(tmp_path / 'journal.jsonl')) == (1, [])
+    assert (tmp_path / 'img' / 'a.jpg').read_bytes() == b'a'
+    # a journal undone twice has nothing left to restore
+    assert undo_journal(str(tmp_path / 'journal.jsonl')) == (0, [])
+
+
+def test_undo_reports_missing_quarantined_file(tmp_path):
+    (tmp_path / 'a.jpg').write_bytes(b'a')
+    journal = str(tmp_path / 'journal.jsonl')
+    with DeleteExecutor('quarantine', journal, quarantine_dir=str(tmp_path / 'q')) as deleter:
+        deleter.submit(str(tmp_path / 'a.jpg'))
+    os.remove(read_journal(journal)[0]['target'])
+    restored, not_undone = undo_journal(journal)
+    assert restored == 0
+    assert [entry['path'] for entry in not_undone] == [str(tmp_path / 'a.jpg')]
@@ -0,0 +1,66 @@
+import os
+
+import numpy
+from PIL import Image
+
+from common.digest import DIGEST_BYTES
+from common.hashcache import UNKNOWN_DIMS, UNKNOWN_STAT, HashCache
+
+
+def write_image(path, seed):
+    # uncompressed images of the same dimensions have the same file size
+    rng = numpy.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=numpy.uint8), 'RGB').save(str(path), format='BMP')
+
+
+def update_cache(cache_path, filenames):
+    hashcache = HashCache(None, [str(f) for f in filenames], 'phash', 8, 1)
+    hashcache.load_hash_dict(str(cache_path), True, None)
+    hashcache.dump_hash_dict(str(cache_path), True)
+    return hashcache
+
+
+def test_file_modified_in_place_with_same_size_is_not_byte_identical(tmp_path):
+    a, b = tmp_path / 'a.bmp', tmp_path / 'b.bmp'
+    write_image(a, 0)
+    write_image(b, 0)
+    cache_path = tmp_path / 'cache'
+    assert update_cache(cache_path, [a, b]).exact_groups() == [[str(a), str(b)]]
+
+    mtime_ns = os.stat(str(b)).st_mtime_ns
+    write_image(b, 1)
+    os.utime(str(b), ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+    assert os.path.getsize(str(a)) == os.path.getsize(str(b))
+
+    hashcache = update_cache(cache_path, [a, b])
+    assert hashcache.exact_groups() == []
+    fresh = HashCache(None, [str(b)], 'phash', 8, 1)
+    fresh.load_hash_dict(None, False, None)
+    rows = {f: row for row, f in enumerate(hashcache.filename_list)}
+    assert (hashcache.hash_matrix[rows[str(b)]] == fresh.hash_matrix[0]).all()
+
+
+def test_missing_file_is_hashed_once_it_exists(tmp_path):
+    a, late = tmp_path / 'a.bmp', tmp_path / 'late.bmp'
+    write_image(a, 0)
+    cache_path = tmp_path / 'cache'
+    hashcache = update_cache(cache_path, [a, late])
+    assert hashcache.filename_list == [str(a)]
+
+    write_image(late, 1)
+    hashcache = update_cache(cache_path, [a, late])
+    assert sorted(hashcache.filenames()) == [str(a), str(late)]
+
+
+def test_failed_row_without_stat_is_hashed_again(tmp_path):
+    a = tmp_path / 'a.bmp'
+    write_image(a, 0)
+    cache_path = tmp_path / 'cache'
+    # row stored by earlier versions for a path which did not exist
+    hashcache = HashCache(None, [], 'phash', 8, 1)
+    hashcache.append_rows([str(a)], numpy.zeros((1, hashcache.hash_bytes), dtype=numpy.uint8), [True],
+        [UNKNOWN_STAT], numpy.zeros((1, DIGEST_BYTES), dtype=numpy.uint8), [UNKNOWN_DIMS])
+    hashcache.dump_hash_dict(str(cache_path), True)
+
+    hashcache = update_cache(cache_path, [a])
+    assert hashcache.filenames() == [str(a)]
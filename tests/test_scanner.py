@@ -0,0 +1,22 @@
+import os
+
+from common.scanner import scan_images
+
+
+def test_scan_follows_directory_symlinks_once(tmp_path):
+    real = tmp_path / 'real'
+    (real / 'deep').mkdir(parents=True)
+    (real / 'a.jpg').write_bytes(b'a')
+    (real / 'deep' / 'b.png').write_bytes(b'b')
+    (real / 'deep' / 'notes.txt').write_bytes(b'c')
+    # a loop back to real and a dangling link
+    os.symlink(str(real), str(real / 'deep' / 'loop'))
+    os.symlink(str(tmp_path / 'nonexistent'), str(real / 'dangling'))
+    linked = tmp_path / 'linked'
+    linked.mkdir()
+    os.symlink(str(real), str(linked / 'link'))
+
+    assert sorted(scan_images(str(linked), recursive=True)) == [
+        str(linked / 'link' / 'a.jpg'), str(linked / 'link' / 'deep' / 'b.png')]
+    assert sorted(scan_images(str(real), recursive=True)) == [str(real / 'a.jpg'), str(real / 'deep' / 'b.png')]
+    assert list(scan_images(str(linked), recursive=False)) == []
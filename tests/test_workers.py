@@ -0,0 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from common.hashcache import HashCache
+from common.workers import Workers
+
+
+def test_pools_created_once_by_concurrent_threads():
+    hasher = HashCache(None, [], 'phash', 8, 1)
+    with Workers(1) as workers:
+        with ThreadPoolExecutor(8) as executor:
+            pools = list(executor.map(lambda _i: workers.hash_pool(hasher), range(8)))
+            executors = list(executor.map(lambda _i: workers.threads(), range(8)))
+        assert all(pool is pools[0] for pool in pools)
+        assert all(e is executors[0] for e in executors)